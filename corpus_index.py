@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+from array import array
+
+from utils import parse_play, encode_scene
+
+
+# This file implements an index of the plays of a corpus, so that experiments do not parse the same plays again. The
+# index is a JSON lines file, with one line per play giving its title, its acts (as successions of characters talking),
+# their normalized form (see utils.encode_scene, written as lists of integers) and the size of their alphabets. A play
+# is only parsed again when its content has changed since it was indexed, or when its entry was written in an older
+# format.
+
+INDEX_NAME = 'corpus_index.jsonl'
+INDEX_VERSION = 2
+
+
+def file_hash(path):
+    """Returns the hexadecimal SHA-256 hash of the content of a file"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def index_play(path, relative_path):
+    """Parses a play and returns its entry in the index.
+    Args:
+        path(str): Path of the play
+        relative_path(str): Path of the play relative to the folder of the corpus
+    Returns:
+        dict: entry of the play
+    """
+    title, acts = parse_play(path)
+    normalized = [encode_scene(act, True) for act in acts]
+    stat = os.stat(path)
+    return {'version': INDEX_VERSION, 'path': relative_path, 'mtime': stat.st_mtime, 'size': stat.st_size,
+            'sha256': file_hash(path), 'title': title, 'acts': acts,
+            'normalized acts': [u.tolist() for (u, _) in normalized], 'characters': [d for (_, d) in normalized],
+            'alphabet sizes': [len(d) for (_, d) in normalized]}
+
+
+def load_corpus_index(folder, index_path=None):
+    """Returns the index of the plays of a corpus, after updating it: plays which were modified since they were indexed
+    (their modification time or size changed, and so did their content), which were indexed in an older format, or
+    which were not indexed yet are parsed, and plays which do not exist anymore are removed. The index file is only
+    written again if something changed.
+    Args:
+        folder(str): Folder of the corpus. Must be a folder of folders containing plays
+        index_path(str): Path of the index file, folder/corpus_index.jsonl by default
+    Returns:
+        dict: Entries of the plays (see index_play), indexed by their path (os.path.join(folder, relative path),
+        normalized with os.path.normpath)
+    """
+    if index_path is None:
+        index_path = os.path.join(folder, INDEX_NAME)
+    old_entries = dict()
+    if os.path.exists(index_path):
+        with open(index_path, 'r', encoding='utf-8') as index_file:
+            for line in index_file:
+                entry = json.loads(line)
+                old_entries[entry['path']] = entry
+
+    entries, changed = dict(), False
+    for f in sorted(os.listdir(folder)):
+        folder_path = os.path.join(folder, f)
+        if not os.path.isdir(folder_path):
+            continue
+        for play in sorted(os.listdir(folder_path)):
+            relative_path = os.path.join(f, play)
+            path = os.path.join(folder, relative_path)
+            stat = os.stat(path)
+            entry = old_entries.get(relative_path)
+            if entry is not None and entry.get('version') != INDEX_VERSION:
+                entry = None
+            if entry is not None and (entry['mtime'], entry['size']) != (stat.st_mtime, stat.st_size):
+                # Only the modification time may have changed
+                if entry['size'] == stat.st_size and entry['sha256'] == file_hash(path):
+                    entry['mtime'] = stat.st_mtime
+                else:
+                    entry = None
+                changed = True
+            if entry is None:
+                entry = index_play(path, relative_path)
+                changed = True
+            entries[relative_path] = entry
+    changed = changed or len(entries) != len(old_entries)
+
+    if changed:
+        with open(index_path, 'w', encoding='utf-8') as index_file:
+            for entry in entries.values():
+                index_file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+    return {os.path.normpath(os.path.join(folder, relative_path)): entry
+            for (relative_path, entry) in entries.items()}
+
+
+def read_encoded_play(path, index=None):
+    """Returns the title of a play and its acts encoded by utils.encode_scene(act, True), as (parameterized word,
+    dictionnary of characters) pairs. The encoded acts stored in the index of its corpus are used when it is in it (see
+    load_corpus_index), and the play is parsed and encoded otherwise."""
+    entry = index.get(os.path.normpath(path)) if index is not None else None
+    if entry is None:
+        title, acts = parse_play(path)
+        return title, [encode_scene(act, True) for act in acts]
+    return entry['title'], [(array('H', word), characters)
+                            for (word, characters) in zip(entry['normalized acts'], entry['characters'])]
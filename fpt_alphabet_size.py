@@ -1,14 +1,18 @@
-import io, itertools, time
+import functools, importlib, io, itertools, math, time
 import multiprocessing
+import queue as queues
 import os
 import csv
 from typing import List
 from itertools import count
 from multiprocessing import Process
-from xml.dom import minidom
+import numpy as np
 from unidecode import unidecode
 from Levenshtein import distance
-from utils import get_title, get_all_acts_dialogues, normalize_scene
+from utils import encode_scene, word_to_string, position_masks, advance_lcs_state, advance_lcs_state_bounded, \
+    indel_distance, bounded_indel_distance, assignment_lower_bound, frequency_mapping
+from corpus_index import load_corpus_index, read_encoded_play
+from result_cache import ResultCache, cache_key
 
 """
     fpt_alphabet_size v1.0, 2022-12-05
@@ -30,28 +34,37 @@ from utils import get_title, get_all_acts_dialogues, normalize_scene
 """
 
 
-def allPermutationsAfterElement(lst, i):
-    """Returns the list of all permutations of lst keeping the i first elements in place.
+def iterPermutationsAfterElement(lst, i):
+    """Yields all permutations of lst keeping the i first elements in place, one at a time.
 
     Args:
         lst (list): list of elements to permute
-        i (int): Empty set to fill with all sources.
+        i (int): number of elements kept in place
 
-    Returns:
-        list: List of permutations
+    Yields:
+        list: a permutation of lst
     """
-    result = []
     if i == len(lst) - 1:
-        result = [lst]
+        yield lst
     else:
         for j in range(i, len(lst)):
             list2 = lst.copy()
             list2[i] = lst[j]
             list2[j] = lst[i]
-            permutations = allPermutationsAfterElement(list2, i + 1)
-            for permutation in permutations:
-                result.append(permutation)
-    return result
+            yield from iterPermutationsAfterElement(list2, i + 1)
+
+
+def allPermutationsAfterElement(lst, i):
+    """Returns the list of all permutations of lst keeping the i first elements in place.
+
+    Args:
+        lst (list): list of elements to permute
+        i (int): Empty set to fill with all sources.
+
+    Returns:
+        list: List of permutations
+    """
+    return list(iterPermutationsAfterElement(lst, i))
 
 
 def allPermutations(lst):
@@ -64,19 +77,62 @@ def allSubsets(s, n):
     return list(itertools.combinations(s, n))
 
 
+def unrankPermutation(lst, rank):
+    """Returns the permutation of lst at position `rank` in the order of iterPermutationsAfterElement(lst, 0).
+    >>> unrankPermutation([0, 1, 2], 3)
+    [1, 2, 0]
+    """
+    permutation = lst.copy()
+    for i in range(len(lst) - 1):
+        j, rank = divmod(rank, math.factorial(len(lst) - 1 - i))
+        permutation[i], permutation[i + j] = permutation[i + j], permutation[i]
+    return permutation
+
+
+def countCandidates(aAlphabetSize, bAlphabetSize):
+    """Returns the number of (permutation, subset) pairs tried by the exhaustive search, i.e. s1! * C(s2, s1)."""
+    if aAlphabetSize == 0:
+        return 0
+    return math.factorial(aAlphabetSize) * math.comb(bAlphabetSize, aAlphabetSize)
+
+
+def iterCandidates(aAlphabetSize, bAlphabetSize, start=0, stop=None):
+    """Yields the (permutation, subset) pairs of the exhaustive search whose index lies in [start, stop), in the
+    order in which the exhaustive search tries them, without building the list of all permutations. Splitting
+    [0, countCandidates(s1, s2)) into ranges allows to chunk, resume or share a run.
+    Args:
+        aAlphabetSize(int): size of the smallest alphabet, whose characters are permuted
+        bAlphabetSize(int): size of the other alphabet, whose subsets are enumerated
+        start(int): index of the first pair to yield
+        stop(int): index after the last pair to yield, countCandidates(s1, s2) if None
+    Yields:
+        (list,tuple): a permutation of range(s1) and a subset of range(s2) of size s1
+    >>> list(iterCandidates(2, 3, 2, 5))
+    [([0, 1], (1, 2)), ([1, 0], (0, 1)), ([1, 0], (0, 2))]
+    """
+    numberOfSubsets = math.comb(bAlphabetSize, aAlphabetSize)
+    total = countCandidates(aAlphabetSize, bAlphabetSize)
+    stop = total if stop is None else min(stop, total)
+    index = start
+    while index < stop:
+        permutationIndex, subsetIndex = divmod(index, numberOfSubsets)
+        perm = unrankPermutation(list(range(aAlphabetSize)), permutationIndex)
+        lastSubsetIndex = min(numberOfSubsets, subsetIndex + stop - index)
+        for sub in itertools.islice(itertools.combinations(range(bAlphabetSize), aAlphabetSize), subsetIndex,
+                                    lastSubsetIndex):
+            yield perm, sub
+        index += lastSubsetIndex - subsetIndex
+
+
 def characterList(a):
-    """Returns the set of characters of string `a` """
-    charList = []
-    for i in range(0, len(a)):
-        if a[i] not in charList:
-            charList.append(a[i])
-    return charList
+    """Returns the set of characters of string `a`, which may also be a parameterized word written with integers """
+    return list(dict.fromkeys(a))
 
 
 def stringToIntegerList(a):
     """Returns a as a list of integers, each letter corresponding to an integer, ordered by first appearance in a.
     Args:
-        a(str)
+        a(str): string, or sequence of integers (see utils.encode_scene)
     Returns:
         list: a as a list of integers
     """
@@ -91,43 +147,413 @@ def stringToIntegerList(a):
     return integerList
 
 
-def buildString(integerList, characterIntegerList):
-    """Inverse of stringToIntegerList. Rebuilds the string given in integerList using the translation given by characterIntegerList.
+def renameIntegerList(integerList, characterIntegerList):
+    """Renames the characters of integerList so that the k-th integer of characterIntegerList becomes k, the other
+    integers being numbered after them, by increasing value. The renamed words of a permutation and a subset can then
+    be compared directly, without rebuilding strings.
     Args:
-        integerList(list): a string to be rebuilt, written as a list of integers
+        integerList(list): a string to be renamed, written as a list of integers
         characterIntegerList(list): a list of integers appearing in integerList
     Returns:
-        str: integerList with integers replaced by letters of the alphabet.
+        list: integerList with its integers renamed
+    >>> renameIntegerList([0, 1, 2, 1], [2, 0])
+    [1, 2, 0, 2]
     """
-    characterTransformation = {}
-    characterNb = 0
-    string = ""
-    for c in characterIntegerList:
-        characterTransformation[c] = chr(65 + characterNb)
-        characterNb += 1
-
-    for c in range(0, len(integerList)):
+    characterTransformation = {c: k for (k, c) in enumerate(characterIntegerList)}
+    for c in range(max(integerList, default=-1) + 1):
         if c not in characterTransformation:
-            characterTransformation[c] = chr(65 + characterNb)
-            characterNb += 1
-    for i in integerList:
-        string += characterTransformation[i]
-    return string
+            characterTransformation[c] = len(characterTransformation)
+    return [characterTransformation[i] for i in integerList]
+
+
+def maskWords(masks, width):
+    """Splits bitmasks over `width` positions into arrays of 64-bit words, least significant word first.
+    Args:
+        masks(list): list of bitmasks, as given by position_masks
+        width(int): number of positions
+    Returns:
+        numpy.ndarray: array of shape (len(masks), number of words) and type uint64
+    """
+    words = max(1, (width + 63) // 64)
+    return np.array([[(mask >> (64 * w)) & 0xFFFFFFFFFFFFFFFF for w in range(words)] for mask in masks],
+                    dtype=np.uint64).reshape(len(masks), words)
+
+
+def batchedIndelDistances(aIntegerList, bMaskWords, bLength, injections, cutoff=None):
+    """Returns the insertion/deletion distances between a and b for a whole block of injections at once.
+    Renaming a with the k-th injection and comparing it with b is the same as comparing a with b where each
+    character injections[k][c] is relabeled c, so the block describes one relabeled b per row. The bit-parallel
+    algorithm of advance_lcs_state is run on all rows together, with bitmasks split into 64-bit words.
+    With a cutoff, the rows which cannot reach a smaller distance anymore are dropped after each block of 64
+    positions of a (see utils.advance_lcs_state_bounded), and the computation stops once all of them are dropped.
+    Args:
+        aIntegerList(list): string with the smallest alphabet, written as a list of integers
+        bMaskWords(numpy.ndarray): position masks of the characters of b, as given by maskWords
+        bLength(int): length of b
+        injections(numpy.ndarray): array of shape (block size, s1), injections[k][c] being the character of b
+            associated to the character c of a by the k-th injection
+        cutoff(int): when given, distances which are not smaller than cutoff are replaced by cutoff
+    Returns:
+        numpy.ndarray: distance for each injection of the block
+    """
+    blockSize, words = injections.shape[0], bMaskWords.shape[1]
+    # table[k, c] is the bitmask of the positions of b matched by character c of a with the k-th injection
+    table = bMaskWords[injections]
+    full = np.full(words, 0xFFFFFFFFFFFFFFFF, dtype=np.uint64)
+    if bLength % 64:
+        full[-1] = (1 << (bLength % 64)) - 1
+    state = np.tile(full, (blockSize, 1))
+    distances = np.full(blockSize, cutoff if cutoff is not None else 0, dtype=np.int64)
+    rows = np.arange(blockSize)
+    for (i, c) in enumerate(aIntegerList):
+        u = state & table[:, c, :]
+        # state - u is state ^ u as u is a submask of state, state + u is computed word by word with carries
+        difference = state ^ u
+        carry = np.zeros(len(rows), dtype=np.uint64)
+        for w in range(words):
+            total = state[:, w] + u[:, w]
+            overflow = total < u[:, w]
+            total += carry
+            overflow |= total < carry
+            state[:, w] = total | difference[:, w]
+            carry = overflow.astype(np.uint64)
+        state &= full
+        left = len(aIntegerList) - i - 1
+        column = bLength - left
+        if cutoff is not None and (i + 1) % 64 == 0 and left > 0 and column > 0:
+            # Common subsequence of a[:i + 1] and b[:column], which can gain at most left positions
+            columnMask = maskWords([(1 << column) - 1], bLength)[0]
+            prefixLengths = column - np.unpackbits((state & columnMask).view(np.uint8), axis=1).sum(axis=1)
+            alive = len(aIntegerList) + bLength - 2 * (prefixLengths + left) < cutoff
+            rows, state, table = rows[alive], state[alive], table[alive]
+            if not len(rows):
+                return distances
+    # The positions of b in a longest common subsequence are the zeros of the state
+    lcsLengths = bLength - np.unpackbits(state.view(np.uint8), axis=1).sum(axis=1, dtype=np.int64)
+    distances[rows] = len(aIntegerList) + bLength - 2 * lcsLengths
+    if cutoff is not None:
+        np.minimum(distances, cutoff, out=distances)
+    return distances
+
+
+def candidatesToInjections(candidates):
+    """Given a list of (permutation, subset) pairs, returns the array of the corresponding injections, whose k-th
+    row associates the character permutation[t] of a to the character subset[t] of b."""
+    permutations = np.array([perm for (perm, sub) in candidates], dtype=np.intp)
+    subsets = np.array([sub for (perm, sub) in candidates], dtype=np.intp)
+    injections = np.empty_like(permutations)
+    np.put_along_axis(injections, permutations, subsets, axis=1)
+    return injections
+
+
+def frequencyInjection(aIntegerList, bIntegerList, aAlphabetSize, bAlphabetSize):
+    """Cheap heuristic associating the k-th most frequent character of a to the k-th most frequent character of b.
+    Args:
+        aIntegerList(list): string with the smallest alphabet, written as a list of integers
+        bIntegerList(list): other string, written as a list of integers
+        aAlphabetSize(int): number of characters of a
+        bAlphabetSize(int): number of characters of b
+    Returns:
+        list: injection[c] is the character of b associated to the character c of a
+    """
+    mapping = frequency_mapping(aIntegerList, bIntegerList)
+    return [mapping[c] for c in range(aAlphabetSize)]
+
+
+def injectionToPermutationAndSubset(injection):
+    """Writes an injection as the (permutation, subset) pair used by the exhaustive search, such that the k-th
+    character of the permutation is associated to the k-th character of the subset."""
+    subset = tuple(sorted(injection))
+    permutation = [injection.index(d) for d in subset]
+    return permutation, subset
+
+
+def reportIncumbent(queue, dist, injection):
+    """Sends a new best injection up queue, as a message ('incumbent', (distance, permutation, subset)), so that the
+    best solution found so far is known by the parent caller even if the search does not end before the timeout."""
+    if queue is not None:
+        perm, sub = injectionToPermutationAndSubset(injection)
+        queue.put(('incumbent', (dist, perm, sub)))
+
+
+def rootLowerBound(aIntegerList, bIntegerList, aAlphabetSize, bAlphabetSize):
+    """Returns a lower bound of the distance of all injections: the smallest lower bound of the partial injections
+    assigning only the first character of a, the other characters being wildcards."""
+    if aAlphabetSize == 0:
+        return len(bIntegerList)
+    bMasks = position_masks(bIntegerList, bAlphabetSize)
+    others = list(range(bAlphabetSize))
+    return min(indel_distance(aIntegerList, bIntegerList, [d] + [others[:d] + others[d + 1:]] * (aAlphabetSize - 1),
+                              bMasks) for d in range(bAlphabetSize))
+
+
+# Number of positions of a given to the lane pass of searchSubtree between two checks of the lanes
+LANE_BLOCK_SIZE = 64
+
+
+def searchSubtree(aIntegerList, bIntegerList, aAlphabetSize, bAlphabetSize, prefix, smallestDistance,
+                  sharedDistance=None, parentPid=None, queue=None, lowerBound=0, deadline=None):
+    """Branch and bound search among the injections extending prefix, looking for a distance smaller than
+    smallestDistance. Characters of a are assigned one at a time, by order of first appearance, and each partial
+    injection is discarded as soon as a lower bound of the distance of its extensions reaches the best distance found.
+    Args:
+        aIntegerList(list): string with the smallest alphabet, written as a list of integers
+        bIntegerList(list): other string, written as a list of integers
+        aAlphabetSize(int): number of characters of a
+        bAlphabetSize(int): number of characters of b
+        prefix(list): characters of b associated to the first characters of a in all the injections searched
+        smallestDistance(int): only injections with a smaller distance are searched for
+        sharedDistance(multiprocessing.Value): best distance found by all the processes searching in parallel, which
+            is used for pruning and updated when a better injection is found
+        parentPid(int): when given, the search stops if the process which started it has ended
+        queue(multiprocessing.queues.Queue): when given, each better injection is sent to it as soon as it is found
+            (see reportIncumbent)
+        lowerBound(int): lower bound of the distance of all the injections (see utils.assignment_lower_bound)
+        deadline(float): when given, time (as given by time.time) after which no node is explored anymore, the
+            injection returned being then the best one found so far
+    Returns:
+        (int,list,int,int,int): smallest distance found, injection reaching it (None if no injection with a distance
+        smaller than smallestDistance was found), number of nodes explored and pruned, and number of complete
+        injections evaluated
+    """
+    aLength, bLength = len(aIntegerList), len(bIntegerList)
+    full = (1 << bLength) - 1
+    laneWidth = bLength + 1
+    bMasks = position_masks(bIntegerList, bAlphabetSize)
+    firstOccurrence = [aIntegerList.index(c) for c in range(aAlphabetSize)] + [aLength]
+    # Number of occurrences in a of the characters 0..depth
+    assignedOccurrences = list(itertools.accumulate(aIntegerList.count(c) for c in range(aAlphabetSize)))
+    bestInjection = None
+    injection = list(prefix) + [0] * (aAlphabetSize - len(prefix))
+    nodesExplored, nodesPruned, candidatesEvaluated = 0, 0, 0
+
+    def bestDistance():
+        if sharedDistance is None:
+            return smallestDistance
+        return min(smallestDistance, sharedDistance.value)
+
+    def explore(depth, unusedMask, prefixState):
+        # prefixState is the state of the bit-parallel computation before the first occurrence of character depth. As
+        # characters are assigned by order of first appearance, this prefix of a only contains assigned characters, so
+        # its state is computed once and shared by all the extensions of the partial injection
+        nonlocal smallestDistance, bestInjection, nodesExplored, nodesPruned, candidatesEvaluated
+        if parentPid is not None and os.getppid() != parentPid:
+            raise SystemExit('Search interrupted: the parent process has ended')
+        if deadline is not None and time.time() > deadline:
+            return
+        candidates = [d for d in range(bAlphabetSize) if unusedMask & bMasks[d]]
+        # All the children are evaluated in a single bit-parallel pass, each of them using its own lane of len(b) + 1
+        # bits of a large integer (the extra bit receives the carry of the lane, and is cleared at each step).
+        # Masks of the characters of a, with one lane per child: assigned characters have the same mask in all lanes,
+        # character depth is assigned to the character of b of the lane, next characters are wildcards, matching all
+        # the unused characters of b, so that the distance of the lane is a lower bound of the distance of its
+        # extensions
+        lanes = sum(1 << (k * laneWidth) for k in range(len(candidates)))
+        depthMask = sum(bMasks[d] << (k * laneWidth) for (k, d) in enumerate(candidates))
+        wildcardMask = sum((unusedMask ^ bMasks[d]) << (k * laneWidth) for (k, d) in enumerate(candidates))
+        laneMasks = [bMasks[injection[c]] * lanes for c in range(depth)] + [depthMask]
+        laneMasks += [wildcardMask] * (aAlphabetSize - depth - 1)
+        segment = aIntegerList[firstOccurrence[depth]:firstOccurrence[depth + 1]]
+        suffix = aIntegerList[firstOccurrence[depth + 1]:]
+        childStates = advance_lcs_state(prefixState * lanes, [laneMasks[c] for c in segment], full * lanes)
+        # The suffix is given by blocks of LANE_BLOCK_SIZE positions, and the pass stops as soon as no lane can beat
+        # the best distance anymore, with the same diagonal argument as advance_lcs_state_bounded applied to each lane
+        states = childStates
+        for start in range(0, len(suffix), LANE_BLOCK_SIZE):
+            states = advance_lcs_state(states, [laneMasks[c] for c in suffix[start:start + LANE_BLOCK_SIZE]],
+                                       full * lanes)
+            left = len(suffix) - start - LANE_BLOCK_SIZE
+            column = bLength - left
+            if left <= 0 or column <= 0:
+                continue
+            columnMask = (1 << column) - 1
+            # A lane can still beat the best distance if its common subsequence can exceed this length
+            needed = (aLength + bLength - bestDistance()) // 2 - left
+            if all(column - bin((states >> (k * laneWidth)) & columnMask).count('1') <= needed
+                   for k in range(len(candidates))):
+                nodesPruned += len(candidates)
+                return
+        children = []
+        for (k, d) in enumerate(candidates):
+            bound = aLength - bLength + 2 * bin((states >> (k * laneWidth)) & full).count('1')
+            children.append((bound, d, (childStates >> (k * laneWidth)) & full))
+        children.sort(key=lambda child: child[:2])
+        for (k, (bound, d, childState)) in enumerate(children):
+            if max(bound, lowerBound) >= bestDistance():
+                # Children are sorted by lower bound, all the next ones can be pruned too. Once the best distance
+                # reaches lowerBound, a lower bound of the distance of all the injections, every node is pruned: no
+                # better injection can be found
+                nodesPruned += len(children) - k
+                break
+            nodesExplored += 1
+            injection[depth] = d
+            if depth + 1 < aAlphabetSize:
+                # The extensions all have the same distance, and only one of them is evaluated instead of the whole
+                # subtree, if the characters not yet assigned cannot add any match to an alignment (the lower bound is
+                # the distance obtained when they match nothing). Without them, an alignment has at most as many
+                # matches as there are occurrences of the assigned characters in a and of their images in b, which
+                # rules out most nodes without computing anything
+                assignedMatches = min(assignedOccurrences[depth], bLength - bin(unusedMask ^ bMasks[d]).count('1'))
+                equivalent = aLength + bLength - bound <= 2 * assignedMatches
+                if equivalent:
+                    # Stops as soon as the distance cannot be as small as the bound anymore
+                    noMatchState = advance_lcs_state_bounded(childState, [bMasks[injection[c]] if c <= depth else 0
+                                                                          for c in suffix], full,
+                                                             (aLength + bLength - bound + 1) // 2)
+                    equivalent = noMatchState is not None and \
+                        aLength - bLength + 2 * bin(noMatchState).count('1') == bound
+                if not equivalent:
+                    explore(depth + 1, unusedMask ^ bMasks[d], childState)
+                    continue
+                # The first extension is evaluated as the representative of all of them
+                unused = [e for e in range(bAlphabetSize) if unusedMask & bMasks[e] and e != d]
+                injection[depth + 1:] = unused[:aAlphabetSize - depth - 1]
+            # The injection is complete, or represents all the extensions: the lower bound is its actual distance
+            candidatesEvaluated += 1
+            smallestDistance = bound
+            bestInjection = injection.copy()
+            if sharedDistance is not None:
+                # Reported under the lock, so that the distances sent by all the processes keep decreasing
+                with sharedDistance.get_lock():
+                    if bound < sharedDistance.value:
+                        sharedDistance.value = bound
+                        reportIncumbent(queue, bound, bestInjection)
+            else:
+                reportIncumbent(queue, bound, bestInjection)
+
+    unusedMask = full
+    for d in prefix:
+        unusedMask ^= bMasks[d]
+    if len(prefix) == aAlphabetSize:
+        # Nothing left to assign
+        candidatesEvaluated += 1
+        dist = indel_distance(aIntegerList, bIntegerList, injection, bMasks)
+        if dist < bestDistance():
+            smallestDistance, bestInjection = dist, injection
+            reportIncumbent(queue, dist, injection)
+    elif len(prefix) > 0:
+        assignedPart = aIntegerList[:firstOccurrence[len(prefix)]]
+        prefixState = advance_lcs_state(full, [bMasks[injection[c]] for c in assignedPart], full)
+        explore(len(prefix), unusedMask, prefixState)
+    elif aAlphabetSize > 0:
+        explore(0, full, full)
+    return smallestDistance, bestInjection, nodesExplored, nodesPruned, candidatesEvaluated
+
+
+# Best distance and queue shared by the processes of the pool used by branchAndBoundInjection
+sharedBestDistance = None
+sharedQueue = None
+
+
+def initSearchWorker(sharedDistance, queue):
+    """Initializer of the processes of the pool used by branchAndBoundInjection"""
+    global sharedBestDistance, sharedQueue
+    sharedBestDistance = sharedDistance
+    sharedQueue = queue
+
+
+def searchSubtreeTask(args):
+    """Runs searchSubtree in a process of the pool used by branchAndBoundInjection"""
+    aIntegerList, bIntegerList, aAlphabetSize, bAlphabetSize, prefix, parentPid, lowerBound, deadline = args
+    return searchSubtree(aIntegerList, bIntegerList, aAlphabetSize, bAlphabetSize, prefix,
+                         sharedBestDistance.value, sharedBestDistance, parentPid, sharedQueue, lowerBound, deadline)
+
+
+def branchAndBoundInjection(aIntegerList, bIntegerList, aAlphabetSize, bAlphabetSize, workers=1, queue=None,
+                            lowerBound=None, deadline=None):
+    """Finds an injection from the characters of a to the characters of b minimizing the insertion/deletion distance,
+    with the branch and bound search of searchSubtree, starting from the distance given by frequencyInjection. The
+    search stops as soon as this distance reaches lowerBound, which is then the optimal distance.
+    With several workers, the partial injections of the first characters of a are searched by a pool of processes
+    sharing the best distance found so far, so that the pruning of each of them benefits from the others.
+    Args:
+        aIntegerList(list): string with the smallest alphabet, written as a list of integers
+        bIntegerList(list): other string, written as a list of integers
+        aAlphabetSize(int): number of characters of a
+        bAlphabetSize(int): number of characters of b
+        workers(int): number of processes
+        queue(multiprocessing.queues.Queue): when given, each better injection is sent to it as soon as it is found
+        lowerBound(int): lower bound of the distance of all the injections, utils.assignment_lower_bound by default
+        deadline(float): when given, time (as given by time.time) after which the search stops, the injection
+            returned being then the best one found so far, which may not be optimal
+    Returns:
+        (int,list,int,int,int): smallest distance, injection reaching it, number of nodes explored and pruned, and
+        number of complete injections evaluated
+    """
+    if lowerBound is None:
+        lowerBound = assignment_lower_bound(aIntegerList, bIntegerList)
+    bestInjection = frequencyInjection(aIntegerList, bIntegerList, aAlphabetSize, bAlphabetSize)
+    smallestDistance = indel_distance(aIntegerList, bIntegerList, bestInjection)
+    reportIncumbent(queue, smallestDistance, bestInjection)
+    if smallestDistance <= lowerBound:
+        # The injection is optimal, nothing needs to be searched
+        return smallestDistance, bestInjection, 0, 0, 1
+    if workers <= 1:
+        dist, injection, nodesExplored, nodesPruned, candidatesEvaluated = searchSubtree(
+            aIntegerList, bIntegerList, aAlphabetSize, bAlphabetSize, [], smallestDistance, queue=queue,
+            lowerBound=lowerBound, deadline=deadline)
+        if injection is not None:
+            smallestDistance, bestInjection = dist, injection
+        return smallestDistance, bestInjection, nodesExplored, nodesPruned, candidatesEvaluated + 1
+
+    # Splitting the search into subtrees, by assigning enough characters to have several subtrees per worker
+    bMasks = position_masks(bIntegerList, bAlphabetSize)
+    prefixes, depth = [[]], 0
+    while len(prefixes) < 4 * workers and depth < aAlphabetSize:
+        prefixes = [prefix + [d] for prefix in prefixes for d in range(bAlphabetSize) if d not in prefix]
+        depth += 1
+    # The most promising subtrees are searched first, the hopeless ones are not searched at all
+    # The injection given by frequencyInjection has already been evaluated
+    nodesExplored, nodesPruned, candidatesEvaluated = 0, 0, 1
+    bounds = []
+    for prefix in prefixes:
+        unused = [d for d in range(bAlphabetSize) if d not in prefix]
+        bound = bounded_indel_distance(aIntegerList, bIntegerList, prefix + [unused] * (aAlphabetSize - depth),
+                                       smallestDistance, bMasks)
+        if bound < smallestDistance:
+            bounds.append((bound, prefix))
+        else:
+            nodesPruned += 1
+    bounds.sort()
+    sharedDistance = multiprocessing.Value('i', smallestDistance)
+    tasks = [(aIntegerList, bIntegerList, aAlphabetSize, bAlphabetSize, prefix, os.getpid(), lowerBound, deadline)
+             for (bound, prefix) in bounds]
+    with multiprocessing.Pool(workers, initializer=initSearchWorker, initargs=(sharedDistance, queue)) as pool:
+        for (dist, injection, explored, pruned, evaluated) in pool.imap(searchSubtreeTask, tasks):
+            nodesExplored += explored
+            nodesPruned += pruned
+            candidatesEvaluated += evaluated
+            # Results are merged in the order of the tasks, so that ties are broken the same way at each run
+            if injection is not None and dist < smallestDistance:
+                smallestDistance, bestInjection = dist, injection
+    return smallestDistance, bestInjection, nodesExplored, nodesPruned, candidatesEvaluated
 
 
 # FPT algorithm in the size of the alphabets of the two input strings
 # Complexity if s1 is the size of the smallest alphabet of the two input strings
 # and s2 is the size of the alphabet of the other input strings: 
 # O(s1! * A(s2, s1) * poly(size of input strings)) where A(n,k) is the number of arrangements of k elements among n
-def parameterizedAlignment(a, b, queue, pair_name=None):
+def parameterizedAlignment(a, b, queue, pair_name=None, search='branch_and_bound', start=0, stop=None,
+                           block_size=None, workers=1):
     """Returns the Levenshtein parameterized distance between `a` and `b` if the variables are linked by an injection.
-    Sends details about the instance up queue to be logged later.
+    Sends details about the instance up queue to be logged later, as (kind, value) messages, so that the parent caller
+    can log the best solution found so far if the computation does not end before a timeout:
+    ('instance', (a, b)) once a and b are ordered, ('lower bound', bound) with a lower bound of the distance,
+    ('incumbent', (distance, bestPerm, bestSubset)) each time a better solution is found, and finally
+    ('result', csv_row) with all the details of the solution.
     Args:
-        a (str): string to be compared
-        b (str): string to be compared
+        a (str): string to be compared, or parameterized word written with integers (see utils.encode_scene)
+        b (str): string to be compared, or parameterized word written with integers
         queue(multiprocessing.queues.Queue) : queue used to pass results to parent caller
                 characterIntegerList(list): a list of integers appearin in integerList
         pair_name(str): Name describing the instance, for logging purposes.
+        search(str): 'branch_and_bound' to use branchAndBoundInjection, 'exhaustive' to try every permutation of the
+            characters of the smallest alphabet with every subset of the characters of the other one
+        start(int): with the exhaustive search, index of the first (permutation, subset) pair to try
+        stop(int): with the exhaustive search, index after the last pair to try (see iterCandidates)
+        block_size(int): with the exhaustive search, number of pairs scored together by batchedIndelDistances, or
+            None to score them one by one with Levenshtein.distance
+        workers(int): with the branch and bound search, number of processes sharing the search
     Returns:
         str: integerList with integers replaced by letters of the alphabet.
     """
@@ -141,57 +567,101 @@ def parameterizedAlignment(a, b, queue, pair_name=None):
         a, b = b, a
         aCharacterList = characterList(a)
         bCharacterList = characterList(b)
-    allSubs = allSubsets(set(stringToIntegerList(b)), len(aCharacterList))
     aIntegerList = stringToIntegerList(a)
     bIntegerList = stringToIntegerList(b)
-    aCharacterIntegerList = list(range(0, len(aCharacterList)))
-    bCharacterIntegerList = list(range(0, len(bCharacterList)))
-    bCharacterIntegerListSubsets = allSubsets(set(bCharacterIntegerList), len(aCharacterList))
-
-    # Build all permutations of the reference character list
-    permutations = allPermutations(aCharacterIntegerList)
-
-    # For all permutations, compute the Levenshtein distance with all subsets
-    # of the characters of the other string of the reference string's size
-    smallestDistance = len(b) + len(a)
-    bestTransformedA = ""
-    bestTransformedB = ""
-    bestPerm = []
-    bestSubset = []
-    for perm in permutations:
-        transformedA = buildString(aIntegerList, perm)
-        for sub in allSubs:
-            transformedB = buildString(bIntegerList, sub)
-            # below, weights=(1,1,1) for classical Levenshtein distance, weights=(1,1,10) for deletion/insertion
-            # distance
-            dist = distance(transformedA, transformedB, weights=(1, 1, 10))
-            if dist < smallestDistance:
-                smallestDistance = dist
-                bestTransformedA = transformedA
-                bestTransformedB = transformedB
-                bestPerm = perm
-                bestSubset = sub
+    queue.put(('instance', (a, b)))
+    # Neither bound is always the best one: the wildcards of rootLowerBound keep the order of the characters, the
+    # assignment of assignment_lower_bound pairs all of them
+    lowerBound = max(rootLowerBound(aIntegerList, bIntegerList, len(aCharacterList), len(bCharacterList)),
+                     assignment_lower_bound(aIntegerList, bIntegerList))
+    queue.put(('lower bound', lowerBound))
+
+    if search == 'branch_and_bound':
+        smallestDistance, bestInjection, nodesExplored, nodesPruned, candidatesEvaluated = branchAndBoundInjection(
+            aIntegerList, bIntegerList, len(aCharacterList), len(bCharacterList), workers, queue, lowerBound)
+        bestPerm, bestSubset = injectionToPermutationAndSubset(bestInjection)
+        bestTransformedA = renameIntegerList(aIntegerList, bestPerm)
+        bestTransformedB = renameIntegerList(bIntegerList, bestSubset)
+    elif search == 'exhaustive':
+        # For all permutations of the reference character list, compute the Levenshtein distance with all subsets
+        # of the characters of the other string of the reference string's size
+        smallestDistance = len(b) + len(a)
+        bestTransformedA = []
+        bestTransformedB = []
+        bestPerm = []
+        bestSubset = []
+        nodesExplored, nodesPruned = 0, 0
+        candidates = iterCandidates(len(aCharacterList), len(bCharacterList), start, stop)
+        if block_size is not None:
+            bMaskWords = maskWords(position_masks(bIntegerList, len(bCharacterList)), len(b))
+            block = list(itertools.islice(candidates, block_size))
+            while block and smallestDistance > lowerBound:
+                distances = batchedIndelDistances(aIntegerList, bMaskWords, len(b), candidatesToInjections(block),
+                                                  smallestDistance)
+                nodesExplored += len(block)
+                # argmin returns the first smallest distance, as the strict comparison of the scalar loop below
+                k = int(np.argmin(distances))
+                if distances[k] < smallestDistance:
+                    smallestDistance = int(distances[k])
+                    bestPerm, bestSubset = block[k]
+                    queue.put(('incumbent', (smallestDistance, bestPerm, bestSubset)))
+                block = list(itertools.islice(candidates, block_size))
+            bestTransformedA = renameIntegerList(aIntegerList, bestPerm)
+            bestTransformedB = renameIntegerList(bIntegerList, bestSubset)
+        else:
+            transformedA, lastPerm = [], None
+            for perm, sub in candidates:
+                if perm is not lastPerm:
+                    lastPerm = perm
+                    transformedA = renameIntegerList(aIntegerList, perm)
+                transformedB = renameIntegerList(bIntegerList, sub)
+                # below, weights=(1,1,1) for classical Levenshtein distance, weights=(1,1,10) for deletion/insertion
+                # distance
+                dist = distance(transformedA, transformedB, weights=(1, 1, 10), score_cutoff=smallestDistance - 1)
+                nodesExplored += 1
+                if dist < smallestDistance:
+                    smallestDistance = dist
+                    bestTransformedA = transformedA
+                    bestTransformedB = transformedB
+                    bestPerm = perm
+                    bestSubset = sub
+                    queue.put(('incumbent', (smallestDistance, bestPerm, bestSubset)))
+                    if smallestDistance <= lowerBound:
+                        # No injection can do better
+                        break
+        # Each pair of a permutation and a subset is a distinct injection, all of them are evaluated
+        candidatesEvaluated = nodesExplored
+    else:
+        raise ValueError(f'Unknown search method: {search}')
 
     print("Smallest distance: " + str(smallestDistance))
-
-    csv_row = {"pair name": pair_name, "distance": str(smallestDistance), "input1": a, "input2": b,
-               "renamed input 1": bestTransformedA, "renamed input 2": bestTransformedB,
+    # With a range of the exhaustive search, the distance is only the smallest one in this range, unless it reaches the
+    # lower bound
+    optimal = search == 'branch_and_bound' or (start == 0 and stop is None) or smallestDistance <= lowerBound
+    if optimal:
+        lowerBound = smallestDistance
+
+    csv_row = {"pair name": pair_name, "distance": str(smallestDistance), "input1": word_to_string(a),
+               "input2": word_to_string(b), "renamed input 1": word_to_string(bestTransformedA),
+               "renamed input 2": word_to_string(bestTransformedB),
                "bestPerm": str(bestPerm), "bestSubset": str(bestSubset),
                "bijection": str(list(zip(bestPerm, bestSubset))),
-               "computing time": str(time.time() - startTime)}
-    for x in csv_row:
-        queue.put((x, csv_row[x]))
+               "computing time": str(time.time() - startTime),
+               "nodes explored": nodesExplored, "nodes pruned": nodesPruned,
+               "candidates evaluated": candidatesEvaluated, "lower bound": str(lowerBound), "optimal": optimal}
+    queue.put(('result', csv_row))
     return smallestDistance
 
 
 def encode_scenes(scene1, scene2):
-    """Given two files of plays, encodes them as parameterized words and saves the equivalences in dictionnaries."""
-    u, d1 = normalize_scene(scene1, True)
-    v, d2 = normalize_scene(scene2, True)
+    """Given two files of plays, encodes them as parameterized words written with integers (see utils.encode_scene) and
+    saves the equivalences in dictionnaries."""
+    u, d1 = encode_scene(scene1, True)
+    v, d2 = encode_scene(scene2, True)
     return '', d1, d2, u, v
 
 
-def compare_pieces(f1, f2, pair_name, gwriter, timeout=60):
+def compare_pieces(f1, f2, pair_name, gwriter, timeout=60, workers=1, cache=None, index=None):
     """Given two files of plays, run the parameterized matching comparison and logs the results.
     Logs the result in a csv file given by gwriter.
     Args:
@@ -200,12 +670,15 @@ def compare_pieces(f1, f2, pair_name, gwriter, timeout=60):
         pair_name(str): Name of the two plays
         gwriter(csv.DictWriter) : Writer for the csv output
         timeout(int): Only used for logging purposes, when called with a timeout
+        workers(int): Number of processes searching each act pair
+        cache(ResultCache): When given, act pairs already compared are not compared again (see result_cache.py),
+            unless their comparison timed out with a smaller timeout, and new results are stored in it
+        index(dict): Index of the corpus of the plays (see corpus_index.py), to read them from when they are in it
         """
-    # Getting plays, titles, and acts
-    piece1 = minidom.parse(open(f1, 'rb'))
-    piece2 = minidom.parse(open(f2, 'rb'))
-    title1, title2 = unidecode(get_title(piece1)), unidecode(get_title(piece2))
-    acts1, acts2 = get_all_acts_dialogues(piece1), get_all_acts_dialogues(piece2)
+    # Getting plays, titles, and acts encoded as parameterized words
+    title1, acts1 = read_encoded_play(f1, index)
+    title2, acts2 = read_encoded_play(f2, index)
+    title1, title2 = unidecode(title1), unidecode(title2)
 
     # Comparing number of acts of each play
     if len(acts1) != len(acts2):
@@ -214,55 +687,109 @@ def compare_pieces(f1, f2, pair_name, gwriter, timeout=60):
         print(f" Warning : {title1} and {title2} do not have the same number of acts. Comparing only first {m} acts")
 
     # We compare act 1 with act 1, 2 with 2, etc
-    for (act_number, (a1, a2)) in enumerate(zip(acts1, acts2)):
+    for (act_number, ((normalized_a1, d1), (normalized_a2, d2))) in enumerate(zip(acts1, acts2)):
         # New act
         print(f'Act {act_number + 1}')
-
-        # Encoding the acts as parameterized words
-        input_name, d1, d2, normalized_a1, normalized_a2 = encode_scenes(a1, a2)
         smallest_alphabet_size = min(len(d1), len(d2))
 
+        key = cache_key(normalized_a1, normalized_a2, False, False, 'fpt')
+        cached = cache.get(key, timeout) if cache is not None else None
+        if cached is not None:
+            csv_row = cached['row']
+            csv_row["pair name"] = f'{pair_name}_{act_number + 1}'
+            gwriter.writerow(csv_row)
+            print(f'done for act {act_number + 1} (already in the cache)')
+            continue
+
         # Now we call the FPT algorithm
         # We execute it with a timeout. To do so, we use the multiprocessing library.
         print('Calling resolution algorithm ...')
-        # What we want to get back from the call is a dictionnary. It is however unhashable, and therefore cannot be
-        # obtained directly as a return of the call. Hence we use a queue to stock all the results and only put them
-        # in a dictionnary aftewards.
+        # The algorithm sends its results through a queue: its best solution each time it improves, so that the best
+        # solution found so far can be logged in case of a timeout, and finally the whole csv row.
         queue = multiprocessing.Queue()
-        csv_row = dict()
         p1 = Process(target=parameterizedAlignment,
-                     args=(normalized_a1, normalized_a2, queue, f'{pair_name}_{act_number + 1}'), name='FPTtry')
+                     args=(normalized_a1, normalized_a2, queue, f'{pair_name}_{act_number + 1}'),
+                     kwargs={'workers': workers}, name='FPTtry')
         p1.start()
-        p1.join(timeout=timeout)
-        # Case 1 : call has timed out, we fill the csv accordingly
-        if p1.exitcode is None:
-            p1.kill()
-            # TODO: Log the best solution found instead
-            csv_row = {"pair name": f'{pair_name}_{act_number + 1}', "distance": None, "input1": normalized_a1,
-                       "input2": normalized_a2,
+        deadline = time.time() + timeout
+        instance, incumbent, lower_bound, csv_row = None, None, None, None
+        ended = False
+        while csv_row is None:
+            remaining = deadline - time.time()
+            try:
+                if ended:
+                    # The process may have sent its last messages between the timeout of get and is_alive
+                    kind, value = queue.get_nowait()
+                else:
+                    kind, value = queue.get(timeout=min(max(remaining, 0), 1))
+            except queues.Empty:
+                if remaining <= 0 or ended:
+                    break
+                ended = not p1.is_alive()
+                continue
+            if kind == 'instance':
+                instance = value
+            elif kind == 'lower bound':
+                lower_bound = value
+            elif kind == 'incumbent':
+                incumbent = value
+            elif kind == 'result':
+                csv_row = value
+        # Case 1 : call has timed out, or the process ended without a result, we log the best solution found so far
+        crashed = False
+        if csv_row is None:
+            # A process which failed, or ended by itself before the deadline without sending its result, has crashed
+            # (killed by the system when out of memory, for instance): this is not a timeout, and a new run may
+            # succeed, so the result is not cached
+            crashed = p1.exitcode is not None and (p1.exitcode != 0 or remaining > 0)
+            if crashed:
+                print(f'Warning : the comparison of {pair_name}, act {act_number + 1} ended with exit code '
+                      f'{p1.exitcode} without a result')
+            else:
+                p1.kill()
+            p1.join()
+            csv_row = {"pair name": f'{pair_name}_{act_number + 1}', "distance": None,
+                       "input1": word_to_string(normalized_a1), "input2": word_to_string(normalized_a2),
                        "renamed input 1": None, "renamed input 2": None,
                        "bestPerm": None, "bestSubset": None,
                        "bijection": None,
-                       "computing time": 'TIMEOUT', "alphabet size": smallest_alphabet_size}
+                       "computing time": f'CRASHED (exit code {p1.exitcode})' if crashed else 'TIMEOUT',
+                       "nodes explored": None, "nodes pruned": None, "candidates evaluated": None,
+                       "lower bound": lower_bound, "optimal": False}
+            if incumbent is not None:
+                smallest_distance, best_perm, best_subset = incumbent
+                a, b = instance
+                csv_row.update({"distance": str(smallest_distance), "input1": word_to_string(a),
+                                "input2": word_to_string(b),
+                                "renamed input 1": word_to_string(renameIntegerList(a, best_perm)),
+                                "renamed input 2": word_to_string(renameIntegerList(b, best_subset)),
+                                "bestPerm": str(best_perm), "bestSubset": str(best_subset),
+                                "bijection": str(list(zip(best_perm, best_subset)))})
         # Case 2 : Success
         else:
-            p1.kill()
-            for i in range(10):
-                k, v = queue.get()
-                csv_row[k] = v
-            queue.empty()
-            csv_row["alphabet size"] = smallest_alphabet_size
+            p1.join()
+        csv_row["alphabet size"] = smallest_alphabet_size
+        if cache is not None and not crashed:
+            found_distance = int(csv_row["distance"]) if csv_row["distance"] is not None else None
+            computing_time = float(csv_row["computing time"]) if csv_row["optimal"] else timeout
+            cache.put(key, found_distance, csv_row["bijection"], csv_row["optimal"], computing_time, timeout, csv_row)
         gwriter.writerow(csv_row)
         print(f'done for act {act_number + 1}')
 
 
-def compare_pieces_corpus(folder, timeout=60, final_output_dir='Resultats FPT'):
+def compare_pieces_corpus(folder, timeout=60, final_output_dir='Resultats FPT', workers=1, cache_path=None,
+                          use_index=False):
     """Compare all pairs of plays in the specified folder by iterating compare_piece.
     Logs all the results in a csv file.
     Args:
         folder(str):path of the folder containing plays to compare. Must be a folder of folders containing 2 plays.
         timeout(int): How long to compute on each pair in seconds
         final_output_dir(str): path of the directory where to write the output
+        workers(int): Number of processes searching each act pair
+        cache_path(str): When given, path of the database where results are kept from one run to the next (see
+            result_cache.py), so that only the act pairs not compared yet are computed
+        use_index(bool): When True, plays are read from the index of the corpus (see corpus_index.py), which is
+            created or updated first, instead of being parsed
         """
     # Todo : Also log number of characters per play
     # Getting the folder of pairs to compare
@@ -270,11 +797,14 @@ def compare_pieces_corpus(folder, timeout=60, final_output_dir='Resultats FPT'):
     final_output_dir = os.path.join(os.getcwd(), final_output_dir)
     # Creating output csv file
     output_csv = open(os.path.join(final_output_dir, f'FPTcomparisons_tm{timeout}.csv'), 'w+')
-    fieldnames = ["pair name", "distance", "input1", "input2", "renamed input 1", "renamed input 2", "bestPerm",
-                  "bestSubset", "bijection", "computing time", "alphabet size"]
+    fieldnames = ["pair name", "distance", "lower bound", "input1", "input2", "renamed input 1", "renamed input 2",
+                  "bestPerm", "bestSubset", "bijection", "computing time", "alphabet size", "nodes explored",
+                  "nodes pruned", "candidates evaluated", "optimal"]
     gwriter = csv.DictWriter(output_csv, fieldnames=fieldnames)
     gwriter.writeheader()
 
+    cache = ResultCache(cache_path) if cache_path is not None else None
+    index = load_corpus_index(folder) if use_index else None
     folders.sort(key=lambda x: os.path.getsize(os.path.join(folder, x)))
     for f in folders:
         pair_name = f
@@ -283,7 +813,185 @@ def compare_pieces_corpus(folder, timeout=60, final_output_dir='Resultats FPT'):
         if os.path.isdir(folder_path):
             plays = os.listdir(folder_path)
             play1, play2 = os.path.join(folder_path, plays[0]), os.path.join(folder_path, plays[1])
-            compare_pieces(play1, play2, pair_name, gwriter, timeout)
+            compare_pieces(play1, play2, pair_name, gwriter, timeout, workers, cache, index)
+    if cache is not None:
+        cache.close()
+
+
+def orderedIntegerLists(a, b):
+    """Writes two strings or parameterized words as lists of integers, the one with the smallest alphabet first.
+    Returns:
+        (list,list,int,int): both strings as lists of integers, and the sizes of their alphabets
+    """
+    if len(characterList(a)) > len(characterList(b)):
+        a, b = b, a
+    return stringToIntegerList(a), stringToIntegerList(b), len(characterList(a)), len(characterList(b))
+
+
+def actPairBounds(pair, heuristic='frequency'):
+    """Returns the pair of normalized acts, and cheap lower and upper bounds of the distance between them: the bound of
+    utils.assignment_lower_bound, and the distance of the injection given by frequencyInjection ('frequency') or by
+    the greedy heuristic of greedy-alignment-heuristic.py ('greedy'), if it is smaller."""
+    aIntegerList, bIntegerList, aAlphabetSize, bAlphabetSize = orderedIntegerLists(*pair)
+    injection = frequencyInjection(aIntegerList, bIntegerList, aAlphabetSize, bAlphabetSize)
+    upperBound = indel_distance(aIntegerList, bIntegerList, injection)
+    if heuristic == 'greedy':
+        greedy = importlib.import_module('greedy-alignment-heuristic')
+        upperBound = min(upperBound, greedy.heuristicParameterizedAlignment(aIntegerList, bIntegerList)[1])
+    elif heuristic != 'frequency':
+        raise ValueError(f'Unknown heuristic: {heuristic}')
+    return pair, assignment_lower_bound(aIntegerList, bIntegerList), upperBound
+
+
+def actPairDistance(pair, timeout=None):
+    """Returns the pair of normalized acts, the distance between them computed by branchAndBoundInjection, and whether
+    it is optimal: when given a timeout in seconds, the search stops after it, and the distance is then the best one
+    found so far."""
+    aIntegerList, bIntegerList, aAlphabetSize, bAlphabetSize = orderedIntegerLists(*pair)
+    deadline = time.time() + timeout if timeout is not None else None
+    dist = branchAndBoundInjection(aIntegerList, bIntegerList, aAlphabetSize, bAlphabetSize, deadline=deadline)[0]
+    return pair, dist, deadline is None or time.time() <= deadline
+
+
+def compare_all_pairs_corpus(folder, k=5, threshold=None, final_output_dir='Resultats FPT', workers=1,
+                             heuristic='frequency', timeout=None):
+    """Compare all pairs of plays of a corpus, and logs the k nearest neighbours of each play in a csv file.
+    The distance between two plays is the sum of the distances between their acts (act 1 with act 1, etc), where each
+    act of the play with more acts which has no counterpart counts as deleted, for its length: otherwise plays with few
+    acts would be close to all the others. The exact distance of a pair of plays is only computed
+    when it can be among the k smallest of one of the plays, or below the threshold: for each pair of acts, a lower
+    bound (utils.assignment_lower_bound) and an upper bound (distance of frequencyInjection) are computed first, and a
+    pair of plays is discarded as soon as its lower bound is larger than the k-th smallest upper bound of both plays.
+    Pairs of plays are compared by increasing lower bound, and their exact distances replace their upper bounds as they
+    are computed, so that later pairs are discarded more often.
+    A pair of acts which is not solved within the timeout gets the best distance found, which is not optimal: the
+    distances of its pairs of plays are then only upper bounds, and logged as such.
+    Args:
+        folder(str): path of the folder containing the plays. Must be a folder of folders containing plays, which are
+            read from the index of the corpus (see corpus_index.py)
+        k(int): number of nearest neighbours kept for each play (None to only use the threshold)
+        threshold(int): when given, the pairs of plays at a distance of at most threshold are also kept
+        final_output_dir(str): path of the directory where to write the output
+        workers(int): number of processes computing the bounds and the exact distances
+        heuristic(str): upper bound of the pairs of acts (see actPairBounds). 'greedy' gives bounds closer to the
+            distances, but costs about 30 ms per pair of acts instead of a few microseconds
+        timeout(float): when given, time in seconds after which the search of the distance of a pair of acts stops
+    Returns:
+        dict: list of pairs (distance, neighbour) kept for each play, by increasing distance
+    """
+    index = load_corpus_index(folder)
+    plays = sorted(index)
+    # Acts are written as tuples of integers, which can be used as keys
+    acts = {play: [tuple(act) for act in index[play]['normalized acts']] for play in plays}
+
+    def unmatchedLength(p, q):
+        # Length of the acts of one of the plays beyond the number of acts of the other one, which are deleted
+        m = min(len(acts[p]), len(acts[q]))
+        return sum(len(act) for act in acts[p][m:] + acts[q][m:])
+
+    # Cheap bounds of all pairs of plays, from the bounds of their pairs of acts
+    actBounds = dict()
+    bounds = dict()
+    # Smallest known upper bound of the distance of each pair of plays, which becomes its distance once computed
+    upperBounds = {play: dict() for play in plays}
+    # The exact distance of a pair of acts is known when both its bounds are equal
+    actDistances = dict()
+
+    def computeBounds(mapper):
+        actPairs = {pair for (p, q) in itertools.combinations(plays, 2) for pair in zip(acts[p], acts[q])}
+        for (pair, lb, ub) in mapper(functools.partial(actPairBounds, heuristic=heuristic), actPairs):
+            actBounds[pair] = (lb, ub)
+            if lb == ub:
+                actDistances[pair] = lb
+        for (p, q) in itertools.combinations(plays, 2):
+            actPairs = list(zip(acts[p], acts[q]))
+            bounds[p, q] = (sum(actBounds[pair][0] for pair in actPairs) + unmatchedLength(p, q),
+                            sum(actBounds[pair][1] for pair in actPairs) + unmatchedLength(p, q))
+            upperBounds[p][q] = upperBounds[q][p] = bounds[p, q][1]
+
+    def kthUpperBound(play):
+        values = sorted(upperBounds[play].values())
+        return values[k - 1] if len(values) >= k else math.inf
+
+    def canBeKept(p, q):
+        # A pair can be among the k nearest neighbours of p only if its lower bound is at most the k-th smallest
+        # upper bound of the pairs of p
+        lb = bounds[p, q][0]
+        if k is None and threshold is None:
+            return True
+        return ((k is not None and lb <= max(kthUpperBound(p), kthUpperBound(q)))
+                or (threshold is not None and lb <= threshold))
+
+    # Pairs of acts whose search timed out, and pairs of plays whose distance is thus not optimal
+    unsolvedActPairs = set()
+    distances, optimal = dict(), dict()
+    solvedActPairs = 0
+
+    def compareExactly(mapper):
+        # Pairs of plays are compared by increasing lower bound, a few at a time, so that the distances computed make
+        # the k-th smallest upper bounds smaller, and more pairs can be discarded
+        nonlocal solvedActPairs
+        batch = []
+        for (n, (p, q)) in enumerate(sorted(bounds, key=lambda pair: bounds[pair][0])):
+            if canBeKept(p, q):
+                batch.append((p, q))
+            if batch and (len(batch) == workers or n == len(bounds) - 1):
+                tasks = {pair for (p, q) in batch for pair in zip(acts[p], acts[q]) if pair not in actDistances}
+                # Longest first, so that the last tasks to end are short
+                tasks = sorted(tasks, key=lambda pair: len(pair[0]) * len(pair[1]), reverse=True)
+                for (pair, dist, solved) in mapper(functools.partial(actPairDistance, timeout=timeout), tasks):
+                    # The search starts from the injection matching characters by frequency, but the upper bound may
+                    # be smaller with another heuristic
+                    actDistances[pair] = dist if solved else min(dist, actBounds[pair][1])
+                    if not solved:
+                        unsolvedActPairs.add(pair)
+                solvedActPairs += len(tasks)
+                for (p, q) in batch:
+                    distances[p, q] = sum(actDistances[pair] for pair in zip(acts[p], acts[q])) + unmatchedLength(p, q)
+                    optimal[p, q] = not unsolvedActPairs.intersection(zip(acts[p], acts[q]))
+                    upperBounds[p][q] = upperBounds[q][p] = distances[p, q]
+                batch = []
+
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            # Bounds are cheap to compute, so they are sent to the processes by chunks
+            computeBounds(functools.partial(pool.imap_unordered, chunksize=64))
+            compareExactly(pool.imap_unordered)
+    else:
+        computeBounds(map)
+        compareExactly(map)
+    print(f'{len(bounds)} pairs of plays, {len(distances)} compared exactly, {solvedActPairs} pairs of acts solved '
+          f'({len(unsolvedActPairs)} of them timed out)')
+
+    neighbours = {play: [] for play in plays}
+    for ((p, q), dist) in distances.items():
+        neighbours[p].append((dist, q))
+        neighbours[q].append((dist, p))
+    for play in plays:
+        neighbours[play].sort()
+        if k is not None:
+            kept = neighbours[play][:k]
+            if threshold is not None:
+                kept += [(dist, q) for (dist, q) in neighbours[play][k:] if dist <= threshold]
+            neighbours[play] = kept
+        elif threshold is not None:
+            neighbours[play] = [(dist, q) for (dist, q) in neighbours[play] if dist <= threshold]
+
+    final_output_dir = os.path.join(os.getcwd(), final_output_dir)
+    with open(os.path.join(final_output_dir, f'FPT_all_pairs_k{k}_threshold{threshold}.csv'), 'w') as output_csv:
+        fieldnames = ["play", "title", "rank", "neighbour", "neighbour title", "distance", "lower bound",
+                      "upper bound", "acts compared", "optimal"]
+        gwriter = csv.DictWriter(output_csv, fieldnames=fieldnames)
+        gwriter.writeheader()
+        for play in plays:
+            for (rank, (dist, q)) in enumerate(neighbours[play]):
+                lb, ub = bounds[min(play, q), max(play, q)]
+                gwriter.writerow({"play": index[play]['path'], "title": index[play]['title'], "rank": rank + 1,
+                                  "neighbour": index[q]['path'], "neighbour title": index[q]['title'],
+                                  "distance": dist, "lower bound": lb, "upper bound": ub,
+                                  "acts compared": min(len(acts[play]), len(acts[q])),
+                                  "optimal": optimal[min(play, q), max(play, q)]})
+    return neighbours
 
 
 if __name__ == "__main__":
@@ -1,4 +1,4 @@
-import io, itertools, time
+import io, itertools, math, random, time
 import multiprocessing
 import os
 import csv
@@ -8,12 +8,9 @@ from multiprocessing import Process
 from xml.dom import minidom
 from unidecode import unidecode
 from Levenshtein import distance
-from utils import get_title, get_all_acts_dialogues, normalize_scene
-
-
-from alignment.sequence import Sequence
-from alignment.vocabulary import Vocabulary
-from alignment.sequencealigner import SimpleScoring, GlobalSequenceAligner
+import numpy as np
+from utils import get_title, get_all_acts_dialogues, encode_scene, indel_distance, position_masks, \
+    advance_lcs_state, advance_lcs_state_bounded, assignment_lower_bound
 
 
 
@@ -108,150 +105,301 @@ def relabelIntegerList(list, relabelingDictionary):
             newList.append(maxOutputLetter+1)    
     return newList
 
-def integerListToString(list):
-    """Transforms an integer list into a string with letters starting from A for 0, B for 1, etc.
+# Scores of the global alignment used to compare two relabelings, as in the first version of the heuristic, which used
+# the "alignment" Python library (https://pypi.org/project/alignment/): match 2, mismatch -1, gap -2
+MATCH_SCORE = 2
+MISMATCH_SCORE = -1
+GAP_SCORE = -2
+
+
+def alignedTargetCounts(aList, bLists, target):
+    """Aligns a word with several words of the same length, and returns for each of them the number of positions where
+    the character target is aligned with itself. The alignment is the one of GlobalSequenceAligner in the alignment
+    library: gaps at the beginning and at the end of both words are free, and when several alignments are optimal, the
+    count is the largest one among those its backtrace enumerates (a diagonal step is always taken when it leads to an
+    optimal alignment, and gaps are only tried otherwise).
+    Instead of enumerating alignments, a single dynamic programming pass computes, for each cell, the alignment score
+    and the largest count of a backtrace from this cell. Rows are computed one at a time with NumPy, for all words of
+    bLists at once: within a row, a chain of gaps in the first word is a running maximum.
     Args:
-        list(list): a list of integers
+        aList(list): first word, written as a list of integers
+        bLists(list): words to align with aList, written as lists of integers of the same length
+        target(int): character whose matches are counted
     Returns:
-        str: string
+        numpy.ndarray: number of matches of target for each word of bLists
+    >>> alignedTargetCounts([0, 1, 0], [[0, 1, 0], [1, 0, 1]], 0)
+    array([2, 1])
     """
-    string = ""
-    for i in list:
-        string += chr(65+i)
-    return string
+    bArray = np.array(bLists, dtype=np.int64).reshape(len(bLists), -1)
+    n, m = len(aList), bArray.shape[1]
+    columns = np.arange(m + 1)
+    # A gap in the second word is free in the last column
+    upGaps = np.full(m, GAP_SCORE)
+    upGaps[-1:] = 0
+    bIsTarget = bArray == target
+    # Offset separating the chains of gaps in the running maximum of the counts, larger than the range of the counts
+    offset = max(n, m) + 2
+    scores = np.zeros((len(bLists), m + 1), np.int64)
+    counts = np.zeros((len(bLists), m + 1), np.int64)
+    for i in range(1, n + 1):
+        c = aList[i - 1]
+        # A gap in the first word is free in the last row
+        leftGap = 0 if i == n else GAP_SCORE
+        diagonal = scores[:, :-1] + np.where(bArray == c, MATCH_SCORE, MISMATCH_SCORE)
+        up = scores[:, 1:] + upGaps
+        newScores = np.zeros_like(scores)
+        newScores[:, 1:] = np.maximum(diagonal, up)
+        newScores = np.maximum.accumulate(newScores - columns * leftGap, axis=1) + columns * leftGap
+
+        # Largest count of a backtrace from each cell, without the gaps in the first word, which come next
+        isDiagonal = newScores[:, 1:] == diagonal
+        isUp = newScores[:, 1:] == up
+        isLeft = newScores[:, 1:] == newScores[:, :-1] + leftGap
+        newCounts = np.zeros_like(counts)
+        newCounts[:, 1:] = np.where(isDiagonal, counts[:, :-1] + (bIsTarget & (c == target)),
+                                    np.where(isUp, counts[:, 1:], -1))
+        # The backtrace from a cell can continue with a gap in the first word when it cannot take a diagonal step:
+        # cells are grouped in chains of such gaps, and each cell takes the maximum of its chain up to it
+        chains = np.ones(counts.shape, np.int64)
+        chains[:, 1:] = ~(~isDiagonal & isLeft)
+        chains = np.cumsum(chains, axis=1) * offset
+        counts = np.maximum.accumulate(newCounts + chains, axis=1) - chains
+        scores = newScores
+    return counts[:, m]
+
 
 def heuristicParameterizedAlignment(a, b):
-    """Greedy heuristic to find an injection between the smallest alphabet of the two input strings to the largest alphabet, hoping to minimize the distance between the two parameterized words, computed with the "alignment" Python library (https://pypi.org/project/alignment/) with match score 2, mismatch score -1, gap opening score -2; aims to find, for each character of the first string, the remaining character of the second string which provides the best mapping with the first one, taking into account previously mapped characters and mapping all remaining characters to a single letter
+    """Greedy heuristic to find an injection between the smallest alphabet of the two input strings to the largest
+    alphabet, hoping to minimize the distance between the two parameterized words. For each character of the first
+    string, it looks for the remaining character of the second string which provides the best mapping with the first
+    one: both characters are relabeled with the same new letter, keeping previously mapped characters and mapping all
+    remaining characters to a single letter, and the pair of characters whose letter is matched the most often in a
+    global alignment of the relabeled strings (see alignedTargetCounts) is mapped.
+    The relabeled second strings do not depend on the character of the first string tried, so they are computed once
+    per step, and aligned all at once with each relabeled first string.
     Args:
-        list(list): a list of integers
+        a(str): string to be compared, or parameterized word written with integers (see utils.encode_scene)
+        b(str): string to be compared, or parameterized word written with integers
     Returns:
-        str: string
+        (dict,int): injection found, from the characters of the string with the smallest alphabet to the characters
+        of the other one (both numbered by order of first appearance), and the insertion/deletion distance between
+        the two strings with this injection
+    >>> heuristicParameterizedAlignment('ABAB', 'CDDCDC')
+    ({0: 0, 1: 1}, 2)
     """
-    print("Looking for parameterized alignment for the following strings:")
-    print(a)
-    print(b)
-    startTime = time.time()
-
     # Put the string with smallest alphabet in a
     aCharacterList = characterList(a)
     bCharacterList = characterList(b)
-
     if len(aCharacterList) > len(bCharacterList):
         a, b = b, a
-        aCharacterList = characterList(a)
-        bCharacterList = characterList(b)
+        aCharacterList, bCharacterList = bCharacterList, aCharacterList
     aIntegerList = stringToIntegerList(a)
     bIntegerList = stringToIntegerList(b)
     aCharacterIntegerList = list(range(0, len(aCharacterList)))
     bCharacterIntegerList = list(range(0, len(bCharacterList)))
-    """
-    print(aCharacterIntegerList)
-    print(bCharacterIntegerList)
-    print(stringToIntegerList(a))
-    print(stringToIntegerList(b))
-    """
+
     aRelabelingDictionary = {}
     bRelabelingDictionary = {}
-    
-    
-    currentlyRelabeledCharacter = 0
-
-    # Create a vocabulary to encode the sequences for their alignment
-    v = Vocabulary()
-    
-    # While the set of remaining characters of the first string to map with characters of the second string is not empty
-    while len(aCharacterIntegerList)>0:
-        aBestRelabelingDictionary = aRelabelingDictionary.copy()
-        bBestRelabelingDictionary = bRelabelingDictionary.copy()
+    injection = {}
+    # While the set of remaining characters of the first string to map with characters of the second string is not
+    # empty
+    for currentlyRelabeledCharacter in range(len(aCharacterList)):
         bestChar1 = aCharacterIntegerList[0]
         bestChar2 = bCharacterIntegerList[0]
-        aBestRelabelingDictionary[bestChar1] = currentlyRelabeledCharacter;
-        bBestRelabelingDictionary[bestChar2] = currentlyRelabeledCharacter;
         highestNumberOfCurrentlyRelabeledCharacters = 0
-        # Test each character of the first string to check if it provides the best alignment with some character of the second string
+        bTempLists = [relabelIntegerList(bIntegerList, {**bRelabelingDictionary, char2: currentlyRelabeledCharacter})
+                      for char2 in bCharacterIntegerList]
+        # Test each character of the first string to check if it provides the best alignment with some character of
+        # the second string
         for char1 in aCharacterIntegerList:
-          aTempRelabelingDictionary = aRelabelingDictionary.copy()
-          aTempRelabelingDictionary[char1] = currentlyRelabeledCharacter;
-          #print("Relabeling first word with dictionary " + str(aTempRelabelingDictionary))
-          tempA = relabelIntegerList(stringToIntegerList(a), aTempRelabelingDictionary)
-          aTempString = integerListToString(tempA)
-          #print(aTempString)
-          # Try to map each character of the second string with char1 
-          for char2 in bCharacterIntegerList:
-            bTempRelabelingDictionary = bRelabelingDictionary.copy()
-            bTempRelabelingDictionary[char2] = currentlyRelabeledCharacter;
-            #print("Relabeling second word with dictionary " + str(bTempRelabelingDictionary))
-            tempB = relabelIntegerList(stringToIntegerList(b), bTempRelabelingDictionary)
-            bTempString = integerListToString(tempB)
-            #print(bTempString)
-            
-            # Encode the sequences to align them.
-            aEncoded = v.encodeSequence(Sequence([*aTempString]))
-            bEncoded = v.encodeSequence(Sequence([*bTempString]))
-            
-            # Create a scoring and align the sequences using global aligner.
-            scoring = SimpleScoring(2, -1)
-            aligner = GlobalSequenceAligner(scoring, -2)
-            score, encodeds = aligner.align(aEncoded, bEncoded, backtrace=True)
-            
-            # Iterate over optimal alignments to count how often the currently relabeled character is properly aligned
-            for encoded in encodeds:
-               alignment = v.decodeSequenceAlignment(encoded)
-               alignmentString = str(alignment).split("\n")
-               # Count the number of aligned currently relabeled characters (occurrences of the character corresponding to char1)
-               numberOfCurrentlyRelabeledCharacters = 0
-               charNumber = 0
-               for char in alignmentString[0]:
-                   if ord(char) == 65+currentlyRelabeledCharacter and ord(alignmentString[1][charNumber]) == 65+currentlyRelabeledCharacter :
-                       numberOfCurrentlyRelabeledCharacters += 1
-                   charNumber += 1
-               if(numberOfCurrentlyRelabeledCharacters > highestNumberOfCurrentlyRelabeledCharacters):
-                   # Update information about the best character mapping found so far : char1 => char2
-                   highestNumberOfCurrentlyRelabeledCharacters = numberOfCurrentlyRelabeledCharacters
-                   aBestRelabelingDictionary = aTempRelabelingDictionary.copy()
-                   bBestRelabelingDictionary = bTempRelabelingDictionary.copy()
-                   bestChar1 = char1
-                   bestChar2 = char2
-                   """
-                   print("Best character mapping found so far for first string: " + str(aBestRelabelingDictionary))
-                   print("Best character mapping found so far for second string: " + str(bBestRelabelingDictionary))
-                   print("Number of aligned currently relabeled characters: " + str(highestNumberOfCurrentlyRelabeledCharacters))
-                   print(alignment)
-                   print('Alignment score:', alignment.score)
-                   print('Percent identity:', alignment.percentIdentity())
-                   """
-        
+            tempA = relabelIntegerList(aIntegerList, {**aRelabelingDictionary, char1: currentlyRelabeledCharacter})
+            counts = alignedTargetCounts(tempA, bTempLists, currentlyRelabeledCharacter)
+            # The first character of the second string with the most matches, as they are tried in order
+            k = int(np.argmax(counts))
+            if counts[k] > highestNumberOfCurrentlyRelabeledCharacters:
+                # Update information about the best character mapping found so far : char1 => char2
+                highestNumberOfCurrentlyRelabeledCharacters = counts[k]
+                bestChar1 = char1
+                bestChar2 = bCharacterIntegerList[k]
+
         # Prepare the next step, update the relabeling dictionary with the best pair char1 => char2 found in this step
-        currentlyRelabeledCharacter += 1
-        aRelabelingDictionary = aBestRelabelingDictionary.copy()
-        bRelabelingDictionary = bBestRelabelingDictionary.copy()
+        aRelabelingDictionary[bestChar1] = currentlyRelabeledCharacter
+        bRelabelingDictionary[bestChar2] = currentlyRelabeledCharacter
+        injection[bestChar1] = bestChar2
         aCharacterIntegerList.remove(bestChar1)
         bCharacterIntegerList.remove(bestChar2)
-        """
-        print(aCharacterIntegerList)
-        print(bCharacterIntegerList)
-
-        print("Best character mapping found so far for first string: " + str(aRelabelingDictionary))
-        print("Best character mapping found so far for second string: " + str(bRelabelingDictionary))
-        """
-    tempA = relabelIntegerList(stringToIntegerList(a), aRelabelingDictionary)
-    tempB = relabelIntegerList(stringToIntegerList(b), bRelabelingDictionary)
-    aTempString = integerListToString(tempA)
-    bTempString = integerListToString(tempB)
-    print("Strings obtained after applying the character relabeling found by the heuristic")
-    print(aTempString)
-    print(bTempString)
-    aEncoded = v.encodeSequence(Sequence([*aTempString]))
-    bEncoded = v.encodeSequence(Sequence([*bTempString]))
-    # Create a scoring and align the sequences using global aligner.
-    scoring = SimpleScoring(2, -1)
-    aligner = GlobalSequenceAligner(scoring, -2)
-    score, encodeds = aligner.align(aEncoded, bEncoded, backtrace=True)
-    alignment = v.decodeSequenceAlignment(encodeds[0])
-    print("Best alignment found (only a substring of the longest string may appear below):")
-    print(alignment)
-    print('Alignment score:', alignment.score)
-    print('Percent identity:', alignment.percentIdentity())
-    
 
-heuristicParameterizedAlignment("TMTMTMTMTMMAUAUAUAUOUOJUJUJMJMJMJMJ","NMNMUMUMUMUMUMKUKUOUOKUUMUMUJUJUJJUJMJMJMJM")
\ No newline at end of file
+    # Insertion/deletion distance obtained with the injection found by the heuristic
+    return injection, indel_distance(aIntegerList, bIntegerList, injection)
+
+
+class InjectionDistance:
+    """Insertion/deletion distance of an injection, updated incrementally when the images of a few characters change.
+    The states of the bit-parallel longest common subsequence computation (see utils.advance_lcs_state) are kept for
+    all prefixes of a: the distance of a move is computed again from the first position of a whose character it
+    changes, so moves on characters which only appear at the end of a are cheap.
+    Args:
+        aIntegerList(list): string with the smallest alphabet, written as a list of integers
+        bIntegerList(list): other string, written as a list of integers
+        bAlphabetSize(int): number of characters of b
+        injection(dict): initial injection, from all the characters of a to characters of b
+    """
+
+    def __init__(self, aIntegerList, bIntegerList, bAlphabetSize, injection):
+        self.aIntegerList = aIntegerList
+        self.width = len(bIntegerList)
+        self.full = (1 << self.width) - 1
+        self.bMasks = position_masks(bIntegerList, bAlphabetSize)
+        self.firstPositions = {}
+        for (position, c) in enumerate(aIntegerList):
+            self.firstPositions.setdefault(c, position)
+        self.injection = dict(injection)
+        self.states = [self.full] + [0] * len(aIntegerList)
+        self.distance = self.update(0)
+
+    def suffixDistance(self, start, injection, bound=None):
+        """Distance with injection, which is the current injection up to the position start of a. When bound is given,
+        the computation stops as soon as the distance cannot be smaller than bound, which is returned instead."""
+        rowMasks = [self.bMasks[injection[c]] for c in self.aIntegerList[start:]]
+        if bound is None:
+            state = advance_lcs_state(self.states[start], rowMasks, self.full)
+        else:
+            needed = (len(self.aIntegerList) + self.width - bound) // 2 + 1
+            state = advance_lcs_state_bounded(self.states[start], rowMasks, self.full, needed)
+            if state is None:
+                return bound
+        dist = len(self.aIntegerList) + self.width - 2 * (self.width - bin(state).count('1'))
+        return dist if bound is None else min(dist, bound)
+
+    def update(self, start):
+        """Computes the states of the positions of a after start again, and returns the distance"""
+        state = self.states[start]
+        for (position, c) in enumerate(self.aIntegerList[start:], start + 1):
+            state = advance_lcs_state(state, (self.bMasks[self.injection[c]],), self.full)
+            self.states[position] = state
+        self.distance = len(self.aIntegerList) + self.width - 2 * (self.width - bin(state).count('1'))
+        return self.distance
+
+    def moveDistance(self, changes, bound=None):
+        """Returns the distance of the injection after a move, given as a dictionnary of new images (or bound, when
+        it is given and the distance is not smaller)"""
+        start = min(self.firstPositions.get(c, len(self.aIntegerList)) for c in changes)
+        return self.suffixDistance(start, {**self.injection, **changes}, bound)
+
+    def applyMove(self, changes):
+        """Changes the current injection, and returns its distance"""
+        start = min(self.firstPositions.get(c, len(self.aIntegerList)) for c in changes)
+        self.injection.update(changes)
+        return self.update(start)
+
+
+def localSearchInjection(aIntegerList, bIntegerList, bAlphabetSize, injection, timeBudget=1.0,
+                         method='hill_climbing', temperature=2.0, seed=0, lowerBound=0):
+    """Improves an injection with local moves: reassigning a character of a to a character of b which is not an image,
+    and swapping the images of two characters of a. Each move is evaluated incrementally (see InjectionDistance), and
+    only until it is clear that it will not be applied.
+    Args:
+        aIntegerList(list): string with the smallest alphabet, written as a list of integers
+        bIntegerList(list): other string, written as a list of integers
+        bAlphabetSize(int): number of characters of b
+        injection(dict): initial injection, from all the characters of a to characters of b
+        timeBudget(float): time in seconds after which the search stops
+        method(str): 'hill_climbing' applies the move giving the smallest distance, as long as it improves the
+            distance. 'simulated_annealing' tries random moves during the whole time budget, and accepts a move
+            making the distance larger by delta with probability exp(-delta / T), where T decreases from temperature
+            to temperature / 100
+        temperature(float): initial temperature of the simulated annealing
+        seed(int): seed of the random choices of the simulated annealing
+        lowerBound(int): lower bound of the distance of all the injections (see utils.assignment_lower_bound): the
+            search stops as soon as it is reached
+    Returns:
+        (dict,int): best injection found and its distance
+    >>> localSearchInjection([0, 1, 0, 1], [0, 1, 2, 1, 2], 3, {0: 1, 1: 0})
+    ({0: 1, 1: 2}, 1)
+    """
+    if method not in ('hill_climbing', 'simulated_annealing'):
+        raise ValueError(f'Unknown local search method: {method}')
+    deadline = time.time() + timeBudget
+    rng = random.Random(seed)
+    current = InjectionDistance(aIntegerList, bIntegerList, bAlphabetSize, injection)
+    bestInjection, bestDistance = dict(current.injection), current.distance
+
+    def moves():
+        # All moves from the current injection, as dictionnaries of new images
+        images = set(current.injection.values())
+        result = [{c: d} for c in current.injection for d in range(bAlphabetSize) if d not in images]
+        result += [{c1: current.injection[c2], c2: current.injection[c1]}
+                   for (c1, c2) in itertools.combinations(current.injection, 2)]
+        return result
+
+    if method == 'hill_climbing':
+        while time.time() < deadline and current.distance > lowerBound:
+            bestMove, bestMoveDistance = None, current.distance
+            for changes in moves():
+                if time.time() >= deadline:
+                    break
+                dist = current.moveDistance(changes, bestMoveDistance)
+                if dist < bestMoveDistance:
+                    bestMove, bestMoveDistance = changes, dist
+            if bestMove is None:
+                break
+            current.applyMove(bestMove)
+        return dict(current.injection), current.distance
+
+    candidateMoves = moves()
+    while candidateMoves and time.time() < deadline and bestDistance > lowerBound:
+        changes = rng.choice(candidateMoves)
+        t = temperature * 0.01 ** (1 - (deadline - time.time()) / timeBudget)
+        # The move is accepted when exp(-delta / t) > r, so the distances which cannot be accepted are not computed
+        # exactly
+        r = rng.random()
+        largestDelta = max(0, math.ceil(-t * math.log(r)) - 1) if r > 0 else len(aIntegerList) + len(bIntegerList)
+        delta = current.moveDistance(changes, current.distance + largestDelta + 1) - current.distance
+        if delta <= largestDelta:
+            current.applyMove(changes)
+            candidateMoves = moves()
+            if current.distance < bestDistance:
+                bestInjection, bestDistance = dict(current.injection), current.distance
+    return bestInjection, bestDistance
+
+
+def refinedParameterizedAlignment(a, b, timeBudget=1.0, method='hill_climbing', seed=0):
+    """Runs heuristicParameterizedAlignment, and improves the injection it finds with localSearchInjection. The local
+    search stops, or is not even started, once the distance reaches the lower bound of utils.assignment_lower_bound,
+    as the injection is then optimal.
+    Args:
+        a(str): string to be compared, or parameterized word written with integers (see utils.encode_scene)
+        b(str): string to be compared, or parameterized word written with integers
+        timeBudget(float): time in seconds given to the local search
+        method(str): 'hill_climbing' or 'simulated_annealing' (see localSearchInjection)
+        seed(int): seed of the random choices of the local search
+    Returns:
+        (dict,int): injection found, as heuristicParameterizedAlignment, and the insertion/deletion distance between
+        the two strings with this injection
+    """
+    injection, dist = heuristicParameterizedAlignment(a, b)
+    if len(characterList(a)) > len(characterList(b)):
+        a, b = b, a
+    aIntegerList, bIntegerList = stringToIntegerList(a), stringToIntegerList(b)
+    lowerBound = assignment_lower_bound(aIntegerList, bIntegerList)
+    if dist <= lowerBound:
+        # The injection of the greedy heuristic is optimal
+        return injection, dist
+    return localSearchInjection(aIntegerList, bIntegerList, len(characterList(b)), injection, timeBudget, method,
+                                seed=seed, lowerBound=lowerBound)
+
+
+if __name__ == "__main__":
+    a, b = "TMTMTMTMTMMAUAUAUAUOUOJUJUJMJMJMJMJ", "NMNMUMUMUMUMUMKUKUOUOKUUMUMUJUJUJJUJMJMJMJM"
+    print("Looking for parameterized alignment for the following strings:")
+    print(a)
+    print(b)
+    startTime = time.time()
+    injection, dist = heuristicParameterizedAlignment(a, b)
+    print('Injection found:', injection)
+    print('Distance with this injection:', dist)
+    print('Computing time:', time.time() - startTime)
+    injection, dist = refinedParameterizedAlignment(a, b)
+    print('Injection after local search:', injection)
+    print('Distance with this injection:', dist)
+    print('Lower bound of the distance:', assignment_lower_bound(encode_scene(a), encode_scene(b)))
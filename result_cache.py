@@ -0,0 +1,105 @@
+import hashlib
+import json
+import sqlite3
+import time
+
+
+# This file implements a persistent cache of the results of comparisons of acts, shared by the FPT algorithm and the
+# max-sat reduction. Comparisons are identified by the normalized words compared (see utils.encode_scene), so that
+# comparing again the same acts, in the same pair of plays or not, only costs a lookup.
+
+def cache_key(u, v, bijective=False, substitutions=False, algorithm=''):
+    """Given the inputs of a comparison, returns the key identifying its result in the cache.
+    Args:
+        u(array): First normalized word, written with integers (see utils.encode_scene)
+        v(array): Second normalized word
+        bijective(bool): Type of renaming
+        substitutions(bool): Whether substitutions are allowed
+        algorithm(str): Name of the algorithm used
+    Returns:
+        str: hexadecimal SHA-256 hash of the inputs
+    >>> from array import array
+    >>> key = cache_key([0, 1, 0], array('H', [0, 1]), False, False, 'fpt')
+    >>> key == cache_key([0, 1, 0], [0, 1], False, False, 'fpt')
+    True
+    >>> cache_key([0, 1, 0], [0, 1], False, False, 'fpt') == cache_key([0, 1], [0, 1, 0], False, False, 'fpt')
+    False
+    """
+    # Arrays are written as lists
+    inputs = json.dumps([u, v, bijective, substitutions, algorithm], default=list)
+    return hashlib.sha256(inputs.encode()).hexdigest()
+
+
+class ResultCache:
+    """Results of comparisons, stored in a SQLite database: distance, renaming, whether the distance is optimal (False
+    after a timeout), computing time and timeout given, and the whole row logged in the csv output.
+    A result found after a timeout is only computed again when given a larger timeout.
+    Args:
+        path(str): Path of the database file, created if needed
+        max_age(float): Results older than max_age seconds are removed (never if None)
+        max_entries(int): Only the max_entries results used most recently are kept (all if None)
+    >>> cache = ResultCache(':memory:')
+    >>> key = cache_key([0, 1, 0], [0, 1], False, False, 'fpt')
+    >>> cache.put(key, 1, 'A : A', True, 0.5, 60, {'distance': 1})
+    >>> cache.get(key, 60)['row']
+    {'distance': 1}
+    >>> cache.put(key, 3, 'A : B', False, 60, 60)
+    >>> cache.get(key, 30)['distance'], cache.get(key, 60)['distance'], cache.get(key, 120)
+    (3, 3, None)
+    """
+
+    def __init__(self, path='comparisons_cache.sqlite', max_age=None, max_entries=None):
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, distance INTEGER, '
+                                'mapping TEXT, optimal INTEGER, computing_time REAL, timeout REAL, row TEXT, '
+                                'created REAL, used REAL)')
+        self.evict()
+
+    def get(self, key, timeout=None):
+        """Returns the result stored for key, as a dictionnary with keys 'distance', 'mapping', 'optimal',
+        'computing_time', 'timeout' and 'row', or None if there is none or if it was found after a timeout smaller
+        than timeout."""
+        entry = self.connection.execute('SELECT distance, mapping, optimal, computing_time, timeout, row FROM results '
+                                        'WHERE key = ?', (key,)).fetchone()
+        if entry is None:
+            return None
+        distance, mapping, optimal, computing_time, stored_timeout, row = entry
+        if not optimal and timeout is not None and (stored_timeout is None or timeout > stored_timeout):
+            return None
+        self.connection.execute('UPDATE results SET used = ? WHERE key = ?', (time.time(), key))
+        self.connection.commit()
+        return {'distance': distance, 'mapping': mapping, 'optimal': bool(optimal), 'computing_time': computing_time,
+                'timeout': stored_timeout, 'row': json.loads(row) if row is not None else None}
+
+    def put(self, key, distance, mapping, optimal, computing_time, timeout=None, row=None):
+        """Stores the result of a comparison, replacing the one stored for the same key if any.
+        Args:
+            key(str): Key of the comparison, given by cache_key
+            distance(int): Distance found (None if no solution was found before the timeout)
+            mapping(str): Renaming found
+            optimal(bool): Whether the distance is optimal
+            computing_time(float): Time spent on the comparison, in seconds
+            timeout(float): Timeout given to the comparison
+            row(dict): Row logged in the csv output, which must be serializable in JSON (other values are converted
+                to strings)
+        """
+        now = time.time()
+        self.connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                (key, distance, mapping, int(bool(optimal)), computing_time, timeout,
+                                 json.dumps(row, default=str) if row is not None else None, now, now))
+        self.connection.commit()
+        self.evict()
+
+    def evict(self):
+        """Removes the results older than max_age, and the ones used least recently beyond max_entries."""
+        if self.max_age is not None:
+            self.connection.execute('DELETE FROM results WHERE created < ?', (time.time() - self.max_age,))
+        if self.max_entries is not None:
+            self.connection.execute('DELETE FROM results WHERE key NOT IN '
+                                    '(SELECT key FROM results ORDER BY used DESC LIMIT ?)', (self.max_entries,))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
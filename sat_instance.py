@@ -1,203 +1,495 @@
-import os, csv
+import importlib, os, csv, io
 import time
 
 from utils import *
 import re
 import doctest
-from xml.dom import minidom
 from unidecode import unidecode
 import subprocess
+import multiprocessing
+import threading
+from result_cache import ResultCache, cache_key
+import fpt_alphabet_size as fpt
+from corpus_index import load_corpus_index, read_encoded_play
 
 
 # This file implements the max-sat reduction
 
-# Alphabetical parameterized word: word of the form ABABCBD... where letters appear consecutively by order of the
-# alphabet. May use other symbols if there are more than 26 letters : the ord() of all characters must be consecutive
-# and start at 65 (ord('A') = 65)
+# Alphabetical parameterized word: word of the form ABABCBD... where characters appear by order of first appearance,
+# written with integers (0, 1, 0, 1, 2, 1, 3...) as given by utils.encode_scene, so that there can be any number of
+# characters
 
 
 def get_max_alphabet_size(s_1, s_2):
     """Given two alphabetical parameterized words, returns the size of the alphabet needed to write both of them
-     i.e. the rank in the alphabet of the largest letter appearing in both.
-    >>> get_max_alphabet_size('ABABC','ABABCBAB')
+     i.e. the largest integer appearing in both, plus one.
+    >>> get_max_alphabet_size([0, 1, 0, 1, 2], [0, 1, 0, 1, 2, 1, 0, 3])
     4"""
-    return max(max(ord(x) for x in s_1), max(ord(x) for x in s_2)) - 64
+    return max(max(s_1, default=-1), max(s_2, default=-1)) + 1
 
 
 def get_pi(alphabet_size):
-    """ Returns an alphabet ['A', 'B', 'C',...] up until the alphabet_size-th letter of the alphabet
+    """ Returns an alphabet [0, 1, 2,...] of alphabet_size characters
     >>> get_pi(0)
     []
     >>> get_pi(3)
-    ['A','B','C']
+    [0, 1, 2]
     """
-    pi = []
-    for i in range(alphabet_size):
-        pi.append(chr(65 + i))
-    return pi
+    return list(range(alphabet_size))
+
+
+def in_band(i, j, n, m, bound):
+    """Whether positions i and j of two words of lengths n and m can be matched in an alignment whose distance is at
+    most bound: the positions before them already cost |i - j| insertions or deletions, and the positions after them
+    |(n - i) - (m - j)|. The pairs of positions left form a band around the diagonal of width about bound.
+    >>> [j for j in range(6) if in_band(2, j, 4, 6, 3)]
+    [2, 3, 4]
+    """
+    return bound is None or abs(i - j) + abs((n - i) - (m - j)) <= bound
 
 
 # We index variables x_i{i,j} and y_{a,b} and keep them in two dictionnaries
-def make_corresp_dictionnaries(string_1, string_2):
+def make_corresp_dictionnaries(string_1, string_2, bound=None):
     """Given two alphabetical parameterized words, fix an enumeration of the variables that will be used in the sat reduction.
     Args:
-        string_1(str): First alphabetical parameterized word
-        string_2(str): Second alphabetical parameterized word
+        string_1(array): First alphabetical parameterized word
+        string_2(array): Second alphabetical parameterized word
+        bound(int): When given, upper bound of the optimal distance: variables x_{i,j} are only created for the pairs
+            of positions which can be matched in an optimal solution (see in_band), and numbered densely
+    Variables y_{a,b} are only created for the characters a of the first word and b of the second one which appear at
+    positions i and j having a variable x_{i,j}: the others could never be used by a match.
     Returns:
-        (dict,dict): Dictionnaries which keys are variables x_{i,j} and y_{a,b} respectively and values are corresponding integers"""
+        (dict,dict): Dictionnaries which keys are variables x_{i,j} and y_{a,b} respectively and values are
+        corresponding integers
+    >>> x_dict, y_dict = make_corresp_dictionnaries([0, 1, 0], [0, 0, 1, 0, 1], 2)
+    >>> list(x_dict), y_dict[0, 0]
+    ([(0, 0), (0, 1), (0, 2), (1, 1), (1, 2), (1, 3), (2, 2), (2, 3), (2, 4)], 10)
+    >>> list(make_corresp_dictionnaries([0, 1, 2, 1], [0, 1], 2)[1])
+    [(0, 0), (1, 0), (1, 1), (2, 0), (2, 1)]
+    """
     n, m = len(string_1), len(string_2)
-    pi_size = get_max_alphabet_size(string_1, string_2)
-    pi = get_pi(pi_size)
+    pi_1 = get_pi(get_max_alphabet_size(string_1, []))
+    pi_2 = get_pi(get_max_alphabet_size([], string_2))
     x_dict, y_dict = dict(), dict()
     value = 0
     for i in range(n):
         for j in range(m):
-            if (i, j) not in x_dict:
+            if (i, j) not in x_dict and in_band(i, j, n, m, bound):
                 value += 1
                 x_dict[i, j] = value
-    for a in pi:
-        for b in pi:
-            if (a, b) not in y_dict:
+    matchable = {(string_1[i], string_2[j]) for (i, j) in x_dict}
+    for a in pi_1:
+        for b in pi_2:
+            if (a, b) not in y_dict and (a, b) in matchable:
                 value += 1
                 y_dict[a, b] = value
     return x_dict, y_dict
 
 
+def make_variables_list(x_dict, y_dict):
+    """Inverse of the enumeration given by make_corresp_dictionnaries, as a list indexed by the variables.
+    Args:
+        x_dict(dict): Dictionnary indexing x_{i,j} variables
+        y_dict(dict): Dictionnary indexing y_{a,b} variables
+    Returns:
+        list: list which element v is ('x', (i, j)) or ('y', (a, b)) when v is the integer of the variable x_{i,j} or
+        y_{a,b}, and None for the integers of no variable (0, and the auxiliary variables of the compact encoding)
+    >>> make_variables_list(*make_corresp_dictionnaries([0], [0]))
+    [None, ('x', (0, 0)), ('y', (0, 0))]
+    """
+    variables = [None] * (max(list(x_dict.values()) + list(y_dict.values()), default=0) + 1)
+    for (pos, value) in x_dict.items():
+        variables[value] = ('x', pos)
+    for (pos, value) in y_dict.items():
+        variables[value] = ('y', pos)
+    return variables
+
+
 def no_double_i_clause(x_dict, i, j1, j2):
-    return " ".join([str(-x_dict[i, j1]), str(-x_dict[i, j2]), "0"])
+    return [-x_dict[i, j1], -x_dict[i, j2]]
 
 
 def no_double_j_clause(x_dict, i1, i2, j):
-    return " ".join([str(-x_dict[i1, j]), str(-x_dict[i2, j]), "0"])
+    return [-x_dict[i1, j], -x_dict[i2, j]]
 
 
 def no_crossing_clause(x_dict, i1, i2, j1, j2):
-    return " ".join([str(-x_dict[i1, j1]), str(-x_dict[i2, j2]), "0"])
+    return [-x_dict[i1, j1], -x_dict[i2, j2]]
 
 
 def function_clause(y_dict, a, b1, b2):
-    return " ".join([str(-y_dict[a, b1]), str(-y_dict[a, b2]), "0"])
+    return [-y_dict[a, b1], -y_dict[a, b2]]
 
 
 def bijective_clause(y_dict, a1, a2, b):
-    return " ".join([str(-y_dict[a1, b]), str(-y_dict[a2, b]), "0"])
+    return [-y_dict[a1, b], -y_dict[a2, b]]
 
 
 def match_clause(x_dict, y_dict, i, j, u, v):
-    return " ".join([str(-x_dict[i, j]), str(y_dict[u[i], v[j]]), "0"])
+    return [-x_dict[i, j], y_dict[u[i], v[j]]]
 
 
-# The SAT instance is generated in the WDIMacs format. Description avaiblable at http://www.maxhs.org/docs/wdimacs.html
-def make_sat_instance(comments: list, string_1, string_2, bijective=False, substitutions=False):
-    """ Create the Max-SAT instance associated to two strings.
+def literals_clause(literals):
+    return " ".join([str(x) for x in literals] + ["0"])
+
+
+# Clauses of the compact encoding, which use auxiliary variables numbered after the variables x and y
+def at_most_one_clauses(variables, first_aux):
+    """Sequential counter encoding of the constraint "at most one of the variables is true" (C. Sinz, Towards an
+    optimal CNF encoding of boolean cardinality constraints, 2005): the auxiliary variable s_k is true when one of the
+    k first variables is, which takes 3k clauses instead of k²/2.
     Args:
-        comments(str): Comment lines to be added to the top of the file.
-        string_1(str): First alphabetical parameterized word
-        string_2(str): Second alphabetical parameterized word
+        variables(list): Integers of the variables
+        first_aux(int): Integer of the first auxiliary variable to use
+    Returns:
+        (list,int): Clauses, as lists of literals, and integer of the first auxiliary variable left unused
+    >>> at_most_one_clauses([1, 2, 3], 4)
+    ([[-1, 4], [-2, 5], [-4, 5], [-2, -4], [-3, -5]], 6)
+    """
+    clauses = []
+    for (k, x) in enumerate(variables):
+        s = first_aux + k
+        if k < len(variables) - 1:
+            clauses.append([-x, s])
+        if k > 0:
+            if k < len(variables) - 1:
+                clauses.append([-(s - 1), s])
+            clauses.append([-x, -(s - 1)])
+    return clauses, first_aux + max(len(variables) - 1, 0)
+
+
+def at_most_k_clauses(literals, k, first_aux):
+    """Sequential counter encoding of the constraint "at most k of the literals are true" (C. Sinz, 2005, as
+    at_most_one_clauses): the auxiliary variable s_{i,c} is true when c of the i + 1 first literals are, which takes
+    O(nk) clauses and auxiliary variables.
+    Args:
+        literals(list): Literals, which may be negative
+        k(int): Largest number of true literals
+        first_aux(int): Integer of the first auxiliary variable to use
+    Returns:
+        (list,int): Clauses, as lists of literals, and integer of the first auxiliary variable left unused
+    >>> at_most_k_clauses([1, 2, 3], 2, 4)
+    ([[-1, 4], [-2, 6], [-4, 6], [-2, -4, 7], [-5, 7], [-2, -5], [-3, -7]], 8)
+    >>> at_most_k_clauses([1, -2], 0, 4)
+    ([[-1], [2]], 4)
+    """
+    if k <= 0:
+        return [[-x] for x in literals], first_aux
+    if k >= len(literals):
+        return [], first_aux
+    clauses = []
+    # s(i, c) is the variable of the counter of the i + 1 first literals reaching c (1 <= c <= k)
+    def s(i, c):
+        return first_aux + i * k + c - 1
+    for (i, x) in enumerate(literals):
+        if i < len(literals) - 1:
+            clauses.append([-x, s(i, 1)])
+            if i > 0:
+                clauses.append([-s(i - 1, 1), s(i, 1)])
+                for c in range(2, k + 1):
+                    clauses.append([-x, -s(i - 1, c - 1), s(i, c)])
+                    clauses.append([-s(i - 1, c), s(i, c)])
+        if i > 0:
+            clauses.append([-x, -s(i - 1, k)])
+    return clauses, first_aux + (len(literals) - 1) * k
+
+
+def frontier_clauses(x_dict, n, m, first_aux):
+    """Encoding of the no_double_i, no_double_j and no_crossing constraints with O(nm) clauses, using an auxiliary
+    variable r_{i,j} for each pair of positions, which is true when there is a match between positions i' <= i and
+    j' >= j. A match (i,j) is then forbidden exactly when r_{i-1,j} or r_{i,j+1} is true.
+    Variables r_{i,j} are only created for the pairs of positions having a variable x_{i,j}. When they form a band
+    around the diagonal (see make_corresp_dictionnaries), r_{i-1,j} and r_{i,j+1} are on the next diagonal: when it is
+    out of the band, no match is possible above and to the right of it, and the clauses using them are not needed.
+    Args:
+        x_dict(dict): Dictionnary indexing x_{i,j} variables
+        n(int): Length of the first word
+        m(int): Length of the second word
+        first_aux(int): Integer of the first auxiliary variable to use
+    Returns:
+        (list,int): Clauses, as lists of literals, and integer of the first auxiliary variable left unused
+    >>> x_dict, _ = make_corresp_dictionnaries([0, 1], [0])
+    >>> frontier_clauses(x_dict, 2, 1, 4)
+    ([[-1, 4], [-2, 5], [-4, 5], [-2, -4]], 6)
+    """
+    clauses = []
+    r_dict = {pos: first_aux + k for (k, pos) in enumerate(x_dict)}
+    for (i, j) in x_dict:
+        r = r_dict[i, j]
+        clauses.append([-x_dict[i, j], r])
+        if (i - 1, j) in r_dict:
+            # r_{i-1,j} implies r_{i,j}, and forbids the match (i,j)
+            clauses.append([-r_dict[i - 1, j], r])
+            clauses.append([-x_dict[i, j], -r_dict[i - 1, j]])
+        if (i, j + 1) in r_dict:
+            # r_{i,j+1} implies r_{i,j}, and forbids the match (i,j)
+            clauses.append([-r_dict[i, j + 1], r])
+            clauses.append([-x_dict[i, j], -r_dict[i, j + 1]])
+    return clauses, first_aux + len(r_dict)
+
+
+def sat_instance_clauses(string_1, string_2, bijective=False, substitutions=False, encoding='legacy', bound=None,
+                         min_matches=None):
+    """ Generates the clauses of the Max-SAT instance associated to two strings, one at a time.
+    Args:
+        string_1(array): First alphabetical parameterized word
+        string_2(array): Second alphabetical parameterized word
         bijective(bool): When True, encodes the problem for PM^d, and for FM^d when False.
         substitutions(bool) : When True, encode the problem with substitutions (unsupported for now).
+        encoding(str): 'legacy' forbids each pair of incompatible matches or renamings with its own clause, which
+            takes O(n²m² + |pi_1||pi_2|(|pi_1| + |pi_2|)) clauses, where pi_1 and pi_2 are the alphabets of both
+            words.
+            'compact' uses auxiliary variables (see frontier_clauses and at_most_one_clauses) to encode the same
+            constraints with O(nm + |pi_1||pi_2|) clauses.
+        bound(int): When given, upper bound of the optimal distance (the distance of any renaming, given by a
+            heuristic): matches are only possible in a band of width about bound around the diagonal (see in_band),
+            which takes O((n + m) * bound) variables x_{i,j} instead of nm, and clauses accordingly.
+        min_matches(int): When given, number of matches of a known solution: solutions with fewer matches are
+            forbidden by hard clauses (an auxiliary variable per position of the shortest word, true when it is not
+            matched, and at most as many of them as in the known solution, see at_most_k_clauses)
+    Yields:
+        (int,list): weight of a clause and the clause, as a list of literals
     Returns:
-        final_string(str): content of the WDIMacs file
+        int: number of variables used, returned when the generator is exhausted
+    >>> list(sat_instance_clauses([0], [0]))
+    [(1, [-1, 2]), (1, [-2, 1]), (1, [1])]
+    >>> len(list(sat_instance_clauses([0, 1] * 10, [1, 0] * 10, encoding='compact')))
+    2728
+    >>> len(list(sat_instance_clauses([0, 1] * 10, [1, 0] * 10, encoding='compact', bound=2)))
+    334
     """
+    if encoding not in ('legacy', 'compact'):
+        raise ValueError(f'Unknown encoding: {encoding}')
 
     # Getting the alphabets of both strings
     n, m = len(string_1), len(string_2)
-    pi_size = get_max_alphabet_size(string_1, string_2)
-    pi = get_pi(pi_size)
+    pi_1 = get_pi(get_max_alphabet_size(string_1, []))
+    pi_2 = get_pi(get_max_alphabet_size([], string_2))
     # Making the dictionnaries to enumerate the variables we will need
-    x_dict, y_dict = make_corresp_dictionnaries(string_1, string_2)
-
-    # Comments in the output have to be prefixed by c
-    # comments is a list of strings
-    # unidecode suppresses weird characters that may trip up maxhs parsing (?)
-    comments_list = [" ".join(["c", unidecode(x)]) for x in comments]
-    comment_string = "\n".join(comments_list)
+    x_dict, y_dict = make_corresp_dictionnaries(string_1, string_2, bound)
+    # Positions of the second word which can be matched with each position of the first one, and conversely
+    columns = [[j for j in range(m) if (i, j) in x_dict] for i in range(n)]
+    rows = [[i for i in range(n) if (i, j) in x_dict] for j in range(m)]
 
     # top is the weight we use to specify a clause is hard in max sat.
     # The sum of the weights of soft clauses is enough
     top = n * m
+    next_aux = len(x_dict) + len(y_dict) + 1
 
-    # No_Double_i clauses
-    clauses_i = []
-    for i in range(n):
-        for j1 in range(m):
-            for j2 in range(m):
-                if j1 != j2:
-                    clauses_i.append((" ".join([f"{top}", no_double_i_clause(x_dict, i, j1, j2)])))
-    clauses_i_string = "\n".join(clauses_i)
-
-    # No_Double_j clauses
-    clauses_j = []
-    for j in range(m):
+    if encoding == 'legacy':
+        # No_Double_i clauses
+        for i in range(n):
+            for (k, j1) in enumerate(columns[i]):
+                for j2 in columns[i][k + 1:]:
+                    yield top, no_double_i_clause(x_dict, i, j1, j2)
+
+        # No_Double_j clauses
+        for j in range(m):
+            for (k, i1) in enumerate(rows[j]):
+                for i2 in rows[j][k + 1:]:
+                    yield top, no_double_j_clause(x_dict, i1, i2, j)
+
+        # No_Crossing clauses
         for i1 in range(n):
-            for i2 in range(n):
-                if i1 != i2:
-                    clauses_j.append((" ".join([f"{top}", no_double_j_clause(x_dict, i1, i2, j)])))
-    clauses_j_string = "\n".join(clauses_j)
-
-    # No_Crossing clauses
-    clauses_crossings = []
-    for i1 in range(n):
-        for i2 in range(i1 + 1, n):
-            for j1 in range(m):
-                for j2 in range(j1):
-                    clauses_crossings.append(" ".join([f"{top}", no_crossing_clause(x_dict, i1, i2, j1, j2)]))
-    clauses_crossings_string = "\n".join(clauses_crossings)
-
-    # Function clauses
-    clauses_function = []
-    for a in pi:
-        for b in pi:
-            for c in pi:
-                if b != c:
-                    clauses_function.append(" ".join([f"{top}", function_clause(y_dict, a, b, c)]))
-    clauses_function_string = "\n".join(clauses_function)
-
-    # Bijective clauses
-    if bijective:
-        clauses_bijective = []
-        for a in pi:
-            for b in pi:
-                for c in pi:
-                    if a != b:
-                        clauses_bijective.append(" ".join([f"{top}", bijective_clause(y_dict, a, b, c)]))
-        clauses_bijective_string = "\n".join(clauses_bijective)
+            for i2 in range(i1 + 1, n):
+                for j1 in columns[i1]:
+                    for j2 in columns[i2]:
+                        if j2 >= j1:
+                            break
+                        yield top, no_crossing_clause(x_dict, i1, i2, j1, j2)
+
+        # Function clauses, for each pair of renamings of a only once
+        for a in pi_1:
+            for b in pi_2:
+                for c in pi_2:
+                    if c > b and (a, b) in y_dict and (a, c) in y_dict:
+                        yield top, function_clause(y_dict, a, b, c)
+    else:
+        # No_Double_i, No_Double_j and No_Crossing clauses
+        clauses, next_aux = frontier_clauses(x_dict, n, m, next_aux)
+        for c in clauses:
+            yield top, c
+
+        # Function clauses
+        for a in pi_1:
+            clauses, next_aux = at_most_one_clauses([y_dict[a, b] for b in pi_2 if (a, b) in y_dict], next_aux)
+            for c in clauses:
+                yield top, c
 
     # Match clauses
-    clauses_match = []
     if substitutions:
         sub_weight = 1
     else:
         sub_weight = top
-    for i in range(n):
-        for j in range(m):
-            clauses_match.append((" ".join([f"{sub_weight}", match_clause(x_dict, y_dict, i, j, string_1, string_2)])))
-    clauses_match_string = "\n".join(clauses_match)
+    for (i, j) in x_dict:
+        yield sub_weight, match_clause(x_dict, y_dict, i, j, string_1, string_2)
+
+    # Support clauses: a renaming y_{a,b} is only chosen if a match uses it. Otherwise the characters which are not
+    # matched could be renamed in many ways, all of them giving the same number of matches, and the solver would
+    # explore these equivalent models
+    supports = {pos: [] for pos in y_dict}
+    for (i, j) in x_dict:
+        supports[string_1[i], string_2[j]].append(x_dict[i, j])
+    for ((a, b), y) in y_dict.items():
+        yield top, [-y] + supports[a, b]
 
-    nbvar = len(string_1) * len(string_2) + pi_size ** 2
-    nb_clauses = len(clauses_match) + len(clauses_function) + len(clauses_crossings) + len(clauses_j) + len(clauses_i)
+    # To maximize
+    for (i, j) in x_dict:
+        yield 1, [x_dict[i, j]]
+
+    # Bijective clauses, for each pair of characters renamed into c only once
+    if bijective and encoding == 'legacy':
+        for a in pi_1:
+            for b in pi_1:
+                for c in pi_2:
+                    if b > a and (a, c) in y_dict and (b, c) in y_dict:
+                        yield top, bijective_clause(y_dict, a, b, c)
+    elif bijective:
+        for b in pi_2:
+            clauses, next_aux = at_most_one_clauses([y_dict[a, b] for a in pi_1 if (a, b) in y_dict], next_aux)
+            for c in clauses:
+                yield top, c
+
+    # Solutions at least as good as a known one
+    if min_matches is not None:
+        if n <= m:
+            groups = [[x_dict[i, j] for j in columns[i]] for i in range(n)]
+        else:
+            groups = [[x_dict[i, j] for i in rows[j]] for j in range(m)]
+        unmatched = list(range(next_aux, next_aux + len(groups)))
+        for (u, group) in zip(unmatched, groups):
+            yield top, [u] + group
+        clauses, next_aux = at_most_k_clauses(unmatched, len(groups) - min_matches, next_aux + len(groups))
+        for c in clauses:
+            yield top, c
+
+    return next_aux - 1
+
+
+# Room left for the header of the WDIMacs file, which is only known once all the clauses have been written
+HEADER_WIDTH = 64
 
-    header = f"p wcnf {nbvar} {nb_clauses} {top}"
 
-    # To maximize
+# The SAT instance is generated in the WDIMacs format. Description avaiblable at http://www.maxhs.org/docs/wdimacs.html
+def write_sat_instance(output, comments: list, string_1, string_2, bijective=False, substitutions=False,
+                       encoding='legacy', bound=None, min_matches=None):
+    """ Write the Max-SAT instance associated to two strings to a file, one clause at a time, so that the memory used
+    does not depend on the size of the instance. The header, which gives the numbers of variables and clauses, is
+    written last: when the file is seekable, room is left for it and filled in at the end (with trailing spaces),
+    otherwise the clauses are generated twice, once to count them and once to write them.
+    Args:
+        output(io.IOBase): File to write to, opened in text or binary mode
+        comments(str): Comment lines to be added to the top of the file.
+        string_1(array): First alphabetical parameterized word
+        string_2(array): Second alphabetical parameterized word
+        bijective(bool): When True, encodes the problem for PM^d, and for FM^d when False.
+        substitutions(bool) : When True, encode the problem with substitutions (unsupported for now).
+        encoding(str): 'legacy' or 'compact' clause encoding (see sat_instance_clauses)
+        bound(int): When given, upper bound of the optimal distance restricting matches to a band around the diagonal
+            (see sat_instance_clauses)
+        min_matches(int): When given, solutions with fewer matches are forbidden (see sat_instance_clauses)
+    Returns:
+        (int,int): number of variables and of clauses of the instance
+    """
+    if isinstance(output, io.TextIOBase):
+        write = output.write
+    else:
+        def write(line):
+            output.write(line.encode())
+
+    def write_clauses(clauses, write_clause):
+        # Returns the number of variables, given at the end of the generator, and the number of clauses
+        nb_clauses = 0
+        while True:
+            try:
+                weight, clause = next(clauses)
+            except StopIteration as end:
+                return end.value, nb_clauses
+            if write_clause is not None:
+                write_clause(f"{weight} {literals_clause(clause)}\n")
+            nb_clauses += 1
 
-    clauses_max = []
-    for i in range(n):
-        for j in range(m):
-            clauses_max.append(" ".join(["1", str(x_dict[i, j]), "0"]))
-    clauses_max_string = "\n".join(clauses_max)
-    all_clauses = [comment_string, header, clauses_i_string, clauses_j_string, clauses_crossings_string,
-                   clauses_function_string, clauses_match_string, clauses_max_string]
-    if bijective and clauses_bijective_string:
-        all_clauses.append(clauses_bijective_string)
+    # top is the weight we use to specify a clause is hard in max sat.
+    # The sum of the weights of soft clauses is enough
+    top = len(string_1) * len(string_2)
+
+    # Comments in the output have to be prefixed by c
+    # comments is a list of strings
+    # unidecode suppresses weird characters that may trip up maxhs parsing (?)
+    for x in comments:
+        write(" ".join(["c", unidecode(x)]) + "\n")
+
+    if output.seekable():
+        header_position = output.tell()
+        write(" " * HEADER_WIDTH + "\n")
+        nbvar, nb_clauses = write_clauses(sat_instance_clauses(string_1, string_2, bijective, substitutions,
+                                                               encoding, bound, min_matches), write)
+        end_position = output.tell()
+        output.seek(header_position)
+        write(f"p wcnf {nbvar} {nb_clauses} {top}".ljust(HEADER_WIDTH))
+        output.seek(end_position)
+    else:
+        nbvar, nb_clauses = write_clauses(sat_instance_clauses(string_1, string_2, bijective, substitutions,
+                                                               encoding, bound, min_matches), None)
+        write(f"p wcnf {nbvar} {nb_clauses} {top}\n")
+        write_clauses(sat_instance_clauses(string_1, string_2, bijective, substitutions, encoding, bound, min_matches),
+                      write)
+    return nbvar, nb_clauses
 
-    all_clauses = [x for x in all_clauses if x != ""]  # Some clauses may not appear on very small inputs
-    final_string = "\n".join(all_clauses)
 
+def make_sat_instance(comments: list, string_1, string_2, bijective=False, substitutions=False, encoding='legacy',
+                      bound=None, min_matches=None):
+    """ Create the Max-SAT instance associated to two strings.
+    Args:
+        comments(str): Comment lines to be added to the top of the file.
+        string_1(array): First alphabetical parameterized word
+        string_2(array): Second alphabetical parameterized word
+        bijective(bool): When True, encodes the problem for PM^d, and for FM^d when False.
+        substitutions(bool) : When True, encode the problem with substitutions (unsupported for now).
+        encoding(str): 'legacy' or 'compact' clause encoding (see sat_instance_clauses)
+        bound(int): When given, upper bound of the optimal distance restricting matches to a band around the diagonal
+            (see sat_instance_clauses). The solution must then be decoded with the same bound
+        min_matches(int): When given, solutions with fewer matches are forbidden (see sat_instance_clauses)
+    Returns:
+        final_string(str): content of the WDIMacs file
+    >>> print(make_sat_instance(['test'], [0], [0]))
+    c test
+    p wcnf 2 3 1
+    1 -1 2 0
+    1 -2 1 0
+    1 1 0
+    <BLANKLINE>
+    """
+    output = io.StringIO()
+    write_sat_instance(output, comments, string_1, string_2, bijective, substitutions, encoding, bound, min_matches)
+    # The room left for the header is only needed in files
+    final_string = re.sub(r"^(p wcnf .*?) +$", r"\1", output.getvalue(), count=1, flags=re.MULTILINE)
     return final_string
 
 
-def encode_scenes(scene1, scene2, name='test', bijective=False, substitutions=False):
+def solution_literals(u, v, mapping, bound=None):
+    """Literals of the variables x_{i,j} and y_{a,b} describing a known solution: the renaming mapping of the
+    characters of u into characters of v, and an optimal alignment of u renamed with v (see utils.alignment_matches).
+    Solvers can start from it (see RC2Solver).
+    Args:
+        u(array): First alphabetical parameterized word
+        v(array): Second alphabetical parameterized word
+        mapping(dict): Renaming of the characters of u into characters of v
+        bound(int): Upper bound given to make_sat_instance, if any, at least the distance of mapping
+    Returns:
+        list: Positive literals of the true variables, and negative literals of the false ones
+    >>> solution_literals([0, 1], [0], {1: 0})
+    [-1, 2, -3, 4]
+    """
+    x_dict, y_dict = make_corresp_dictionnaries(u, v, bound)
+    matches = set(alignment_matches(u, v, mapping))
+    # Only the renamings used by a match are true (see the support clauses of sat_instance_clauses)
+    used = {(u[i], v[j]) for (i, j) in matches}
+    return ([x if pos in matches else -x for (pos, x) in x_dict.items()] +
+            [y if pos in used else -y for (pos, y) in y_dict.items()])
+
+
+def encode_scenes(scene1, scene2, name='test', bijective=False, substitutions=False, encoding='legacy', bound=None):
     """ Given two scenes, create the maxhs input file.
     Args:
         scene1(list): First scene, as a list of characters.
@@ -205,188 +497,509 @@ def encode_scenes(scene1, scene2, name='test', bijective=False, substitutions=Fa
         name(str): Name of the file to create.
         bijective(bool): When True, encodes the problem for PM^d, and for FM^d when False.
         substitutions(bool) : When True, encode the problem with substitutions (unsupported for now).
+        encoding(str): 'legacy' or 'compact' clause encoding (see make_sat_instance)
+        bound(int): When given, upper bound of the optimal distance restricting matches to a band around the diagonal
+            (see make_sat_instance)
     Returns:
         (str,dict,dict,str,str): File name produced, dictionnaries indexing sat variables, normalized scenes.
 
     """
-    u, d1 = normalize_scene(scene1, True)
-    v, d2 = normalize_scene(scene2, True)
-    output_for_maxhs = open(name + '_maxhs', 'w')
-    s = make_sat_instance([str(d1), str(d2)], u, v, bijective, substitutions)
-    output_for_maxhs.write(s)
-    output_for_maxhs.close()
+    u, d1 = encode_scene(scene1, True)
+    v, d2 = encode_scene(scene2, True)
+    with open(name + '_maxhs', 'w') as output_for_maxhs:
+        write_sat_instance(output_for_maxhs, [str(d1), str(d2)], u, v, bijective, substitutions, encoding, bound)
     return name + '_maxhs', d1, d2, u, v
 
 
 # The output format of MAXhs is described at the same adress http://www.maxhs.org/docs/wdimacs.html
-def decode_max_hs_output(d1, d2, u, v, maxhs_answer, name, csv_dict=False):
-    """ Given a maxhs output file, translate it into a human readable output and save it in a separate file.
+def parse_max_hs_output(answer):
+    """ Given the output of maxhs, returns the values of the variables in the solution it found.
     Args:
-        d1(dict): Dictionnary indexing x_{i,j} variables
-        d2(dict): Dictionnary indexing y_{a,b} variables
-        maxhs_answer(str): Path of the wdimacs file to read from
-        name(str): name of the output to create
-        csv_dict(dict): Used for logging purposes
+        answer(iterable): Lines of the output
+    Returns:
+        list: list of the values (1 for true, 0 for false) of the variables 1, 2, ...
+    >>> parse_max_hs_output(['c comment', 'o 1', 's OPTIMUM FOUND', 'v 0110'])
+    [0, 1, 1, 0]
     """
-    answer = open(maxhs_answer, 'r')
-    output_human = open(name + 'output_humain', 'w')
-    positives = None
     for x in answer:
         if x[0] == 'v':
             x = re.sub('[^0,1]', '', x)
             positives = list(x)
             positives = [int(x) for x in positives]
-            break
-    if positives is None:
-        raise ValueError('no timeout given but no solution found')
-    x_dict, y_dict = make_corresp_dictionnaries(u, v)
-    output_human.write(f'Input 1 :{u} \n')
-    output_human.write(f'Input 2 :{v}\n')
+            return positives
+    raise ValueError('no timeout given but no solution found')
+
+
+def decode_max_hs_output(d1, d2, u, v, maxhs_answer, name, csv_dict=False, bound=None):
+    """ Given a maxhs output file, translate it into a human readable output and save it in a separate file.
+    Args:
+        d1(dict): Dictionnary associating the characters of the first scene to their integers in u
+        d2(dict): Dictionnary associating the characters of the second scene to their integers in v
+        maxhs_answer(str): Path of the wdimacs file to read from
+        name(str): name of the output to create
+        csv_dict(dict): Used for logging purposes
+        bound(int): Upper bound given to make_sat_instance, if any
+    """
+    with open(maxhs_answer, 'r') as answer:
+        positives = parse_max_hs_output(answer)
+    decode_solution(d1, d2, u, v, positives, name, csv_dict, bound)
+
+
+def decode_solution(d1, d2, u, v, positives, name, csv_dict=False, bound=None):
+    """ Given the values of the variables in a solution of the Max-SAT instance, translate it into a human readable
+    output and save it in a separate file.
+    Args:
+        d1(dict): Dictionnary associating the characters of the first scene to their integers in u
+        d2(dict): Dictionnary associating the characters of the second scene to their integers in v
+        positives(list): Values of the variables 1, 2, ... (1 for true, 0 for false), as given by parse_max_hs_output
+        name(str): name of the output to create
+        csv_dict(dict): Used for logging purposes
+        bound(int): Upper bound given to make_sat_instance, if any, which gives the same numbering of the variables
+    """
+    output_human = open(name + 'output_humain', 'w')
+    variables = make_variables_list(*make_corresp_dictionnaries(u, v, bound))
+    characters_1, characters_2 = inverse_dic(d1), inverse_dic(d2)
+    output_human.write(f'Input 1 :{word_to_string(u)} \n')
+    output_human.write(f'Input 2 :{word_to_string(v)}\n')
     output_human.write("Littéraux vrais :\n")
     match_number = 0
+    renamed_letters = dict()
     if csv_dict:
         renamed_characters = []
-        renamed_letters = dict()
     for (i, truth_value) in enumerate(positives):
-        if truth_value == 1:
-            pos = invert_dic(x_dict, i + 1)
-            if pos is not None:
+        # The auxiliary variables of the compact encoding are numbered after the variables x and y
+        if truth_value == 1 and i + 1 < len(variables) and variables[i + 1] is not None:
+            kind, pos = variables[i + 1]
+            if kind == 'x':
                 output_human.write(f"Match between positions {pos[0]} et {pos[1]}\n")
                 match_number += 1
             else:
-                pos = invert_dic(y_dict, i + 1)
-                if pos is not None:
-                    a, b = invert_dic(y_dict, i + 1)
-                    character_a, character_b = invert_dic(d1, a), invert_dic(d2, b)
-                    output_human.write(f"y_{a, b} ({character_a} renommé en {character_b})\n")
-                    if csv_dict:
-                        renamed_letters[a] = b
-                        renamed_characters.append(f'{character_a} : {character_b}')
-                else:
-                    print('warning : too many variables')
+                a, b = pos
+                character_a, character_b = characters_1.get(a), characters_2.get(b)
+                output_human.write(f"y_{a, b} ({character_a} renommé en {character_b})\n")
+                renamed_letters[a] = b
+                if csv_dict:
+                    renamed_characters.append(f'{character_a} : {character_b}')
     distance = (len(u) + len(v) - 2 * match_number)
+    # Checking the answer: the best alignment of u renamed with v cannot have fewer matches than the one given by MaxHS
+    renamed_distance = indel_distance(u, v, renamed_letters)
+    if renamed_distance != distance:
+        print(f'warning : the renaming found by MaxHS gives distance {renamed_distance} instead of {distance}')
     if csv_dict:
         csv_dict['Distance'] = distance
         renamed_characters_string = ','.join(renamed_characters)
         csv_dict['Renaming'] = renamed_characters_string
-        renamed_u = [renamed_letters.get(x, x) for x in u]
-        renamed_u = "".join(renamed_u)
+        renamed_u = word_to_string([renamed_letters.get(x, x) for x in u])
         csv_dict['Input 1 renamed'] = renamed_u
         output_human.write(f" First input after renaming :{renamed_u}")
     output_human.write(f" Number of matches : {match_number}, distance ID with bijection : {distance}")
+    output_human.close()
     # TODO : Appropriate logging of bijection and distance type
 
 
-def compare_pieces(f1, f2, pair_name, logs_files, csv_writer, final_output_dir, timeout=800):
-    """Given two files of plays, run the comparison between them with MaxHS and logs the results.
-    Logs the details of computation in logs_files and writes the results in a given csv file.
+# Path of the MaxHS executable. Any solver reading the same input format and printing its solution in the same way
+# (a line "v 0101..." with the value of each variable) can be used instead
+MAXHS_PATH = '/usr/local/MaxHS-2021_eval/build/release/bin/maxhs'
+
+
+# Solver backends: objects with a method solve(name, comments, u, v, bijective, substitutions, encoding, timeout,
+# bound, min_matches, phases), which returns the values of the variables in an optimal solution (as
+# parse_max_hs_output), or None after a timeout. phases are the literals of a known solution (see solution_literals),
+# which backends may ignore
+class ExternalSolver:
+    """Solver run as a separate program, on the WDIMacs file of the instance, which prints its solution in the same
+    format as MaxHS. Its output is read through a pipe. The WDIMacs format cannot give a known solution to the
+    program, so phases are ignored.
+    Args:
+        path(str): Path of the executable
+        flags(list): Options given to the executable before the path of the instance
+    """
+
+    def __init__(self, path=MAXHS_PATH, flags=('-printSoln',)):
+        self.path = path
+        self.flags = list(flags)
+
+    def __repr__(self):
+        return f'ExternalSolver({self.path!r}, {tuple(self.flags)!r})'
+
+    def solve(self, name, comments, u, v, bijective=False, substitutions=False, encoding='legacy', timeout=None,
+              bound=None, min_matches=None, phases=None):
+        input_name = name + '_maxhs'
+        with open(input_name, 'w') as output_for_maxhs:
+            write_sat_instance(output_for_maxhs, comments, u, v, bijective, substitutions, encoding, bound,
+                               min_matches)
+        try:
+            answer = subprocess.run([self.path] + self.flags + [input_name], capture_output=True, text=True,
+                                    timeout=timeout)
+        except subprocess.TimeoutExpired:
+            return None
+        return parse_max_hs_output(answer.stdout.splitlines())
+
+
+class RC2Solver:
+    """Solver run in this process: the RC2 Max-SAT solver of PySAT (https://pysathq.github.io/), which is only imported
+    when used. The clauses are given to it as they are generated, without writing the instance, and the literals of
+    a known solution are given to its SAT solver as preferred phases.
+    Args:
+        sat_solver(str): Name of the SAT solver used by RC2 (see pysat.solvers)
+    """
+
+    def __init__(self, sat_solver='g3'):
+        self.sat_solver = sat_solver
+
+    def __repr__(self):
+        return f'RC2Solver({self.sat_solver!r})'
+
+    def solve(self, name, comments, u, v, bijective=False, substitutions=False, encoding='legacy', timeout=None,
+              bound=None, min_matches=None, phases=None):
+        from pysat.formula import WCNF
+        from pysat.examples.rc2 import RC2
+        # Same weights as in write_sat_instance, where clauses with weight top are hard
+        top = len(u) * len(v)
+        formula = WCNF()
+        for (weight, clause) in sat_instance_clauses(u, v, bijective, substitutions, encoding, bound, min_matches):
+            if weight >= top:
+                formula.append(clause)
+            else:
+                formula.append(clause, weight=weight)
+        with RC2(formula, solver=self.sat_solver) as rc2:
+            if phases is not None:
+                rc2.oracle.set_phases(phases)
+            timer = threading.Timer(timeout, rc2.interrupt) if timeout is not None else None
+            if timer is not None:
+                timer.start()
+            model = rc2.compute(expect_interrupt=timer is not None)
+            if timer is not None:
+                timer.cancel()
+        if model is None:
+            return None
+        return [int(literal > 0) for literal in model]
+
+
+def get_solver(solver):
+    """Returns solver if it is a solver backend, and an ExternalSolver running the executable solver if it is a path"""
+    if isinstance(solver, str):
+        return ExternalSolver(solver)
+    return solver
+
+
+def get_act_jobs(f1, f2, pair_name, index=None):
+    """Given two files of plays, list the comparisons of their acts: act 1 with act 1, 2 with 2, etc.
     Args:
         f1 (str): Path to first play
         f2 (str): Path to second play
         pair_name(str): Name of the two plays compared
-        logs_files(_io.TextIOWrapper) : log file
-        csv_writer(csv.DictWriter) : Writer for the csv output
-        final_output_dir(str):Path to the directory where to save results
-        timeout(int): Time in seconds to execute MaxHS before timing out
-        """
+        index(dict): Index of the corpus of the plays (see corpus_index.py), to read them from when they are in it
+    Returns:
+        list: list of tuples (pair_name, act_number, act_1, act_2), where acts are encoded as given by
+        utils.encode_scene(act, True), so that the encoded acts of the index are used as they are
+    """
     # Getting plays, titles, and acts
-    piece1 = minidom.parse(open(f1, 'rb'))
-    piece2 = minidom.parse(open(f2, 'rb'))
-    title1, title2 = unidecode(get_title(piece1)), unidecode(get_title(piece2))
-    acts1, acts2 = get_all_acts_dialogues(piece1), get_all_acts_dialogues(piece2)
-
-    # Preparing csv output
-    csv_dict = dict()
-    csv_dict['Pair name'] = pair_name
+    title1, acts1 = read_encoded_play(f1, index)
+    title2, acts2 = read_encoded_play(f2, index)
+    title1, title2 = unidecode(title1), unidecode(title2)
 
     # Comparing number of acts of each play
     if len(acts1) != len(acts2):
         m = min(len(acts1), len(acts2))
         acts1, acts2 = acts1[:m], acts2[:m]
         print(f" Warning : {title1} and {title2} do not have the same number of acts. Comparing only first {m} acts")
+    return [(pair_name, act_number + 1, a1, a2) for (act_number, (a1, a2)) in enumerate(zip(acts1, acts2))]
 
+
+def encoded_act(act):
+    """Returns an act encoded as a parameterized word with the dictionnary of its characters, as given by
+    utils.encode_scene(act, True), act being either a list of characters or an act already encoded this way.
+    >>> encoded_act(['#didon', '#enee', '#didon']) == encoded_act(encoded_act(['#didon', '#enee', '#didon']))
+    True
+    """
+    if isinstance(act, tuple):
+        return act
+    return encode_scene(act, True)
+
+
+def heuristic_mapping(u, v, time_limit=10):
+    """Renaming of the characters of u into characters of v with a small distance, from which compare_acts builds the
+    band and the warm start. The branch and bound search of fpt_alphabet_size.py is run first, for at most time_limit
+    seconds: its renaming is optimal when it ends in time. Otherwise the greedy heuristic followed by a local search of
+    greedy-alignment-heuristic.py is run for the same time, and the best of both renamings is kept.
+    Args:
+        u(array): First alphabetical parameterized word
+        v(array): Second alphabetical parameterized word
+        time_limit(float): Time in seconds given to each search
+    Returns:
+        (dict,int): Renaming of the characters of u into characters of v, and its distance (see indel_distance)
+    >>> heuristic_mapping([0, 1, 0, 1, 2], [0, 1, 1, 0])
+    ({0: 0, 1: 1}, 3)
+    """
+    greedy = importlib.import_module('greedy-alignment-heuristic')
+    # Both searches rename the characters of the word with the smallest alphabet
+    swapped = len(set(u)) > len(set(v))
+    a, b = (v, u) if swapped else (u, v)
+    a_integer_list, b_integer_list, a_size, b_size = fpt.orderedIntegerLists(a, b)
+    deadline = time.time() + time_limit
+    dist, injection = fpt.branchAndBoundInjection(a_integer_list, b_integer_list, a_size, b_size,
+                                                  deadline=deadline)[:2]
+    injection = dict(enumerate(injection))
+    if time.time() > deadline:
+        greedy_injection, greedy_dist = greedy.refinedParameterizedAlignment(a_integer_list, b_integer_list,
+                                                                             timeBudget=time_limit)
+        if greedy_dist < dist:
+            injection, dist = greedy_injection, greedy_dist
+    if swapped:
+        injection = {d: c for (c, d) in injection.items()}
+    return injection, dist
+
+
+def compare_acts(pair_name, act_number, a1, a2, final_output_dir, timeout=800, encoding='legacy', solver=MAXHS_PATH,
+                 band=False, warm_start=False, heuristic_time_limit=10):
+    """Run the comparison between two acts with MaxHS. Only writes the files specific to this comparison (MaxHS input,
+    human readable output), so that several comparisons can run at the same time.
+    Args:
+        pair_name(str): Name of the two plays compared
+        act_number(int): Number of the acts compared
+        a1(list or tuple): Act of the first play, as a list of characters or already encoded (see encoded_act)
+        a2(list or tuple): Act of the second play, as a list of characters or already encoded
+        final_output_dir(str):Path to the directory where to save results
+        timeout(int): Time in seconds to execute MaxHS before timing out
+        encoding(str): 'legacy' or 'compact' clause encoding (see make_sat_instance)
+        solver(str or solver backend): Path of the MaxHS executable, or solver backend (ExternalSolver, RC2Solver)
+        band(bool): When True, matches are restricted to the band around the diagonal given by the distance of the
+            renaming of heuristic_mapping (see make_sat_instance)
+        warm_start(bool): When True, the solution given by the renaming of heuristic_mapping is given to the solver
+            (see solution_literals), and solutions with fewer matches are forbidden (see make_sat_instance)
+        heuristic_time_limit(float): Time in seconds given to each search of heuristic_mapping, when band or
+            warm_start is True
+    Returns:
+        (dict,str): Row of the csv output, and line of the log file
+    """
+    # New act
+    print(f'{pair_name}, act {act_number}')
+    # Preparing csv output
+    csv_dict = dict()
+    csv_dict['Pair name'] = pair_name
+    csv_dict['Act Number'] = act_number
+
+    # Encoding the acts as parameteried words
+    t1 = time.time()  # Measuring computing time of MaxHS on this instance
+    normalized_a1, d1 = encoded_act(a1)
+    normalized_a2, d2 = encoded_act(a2)
+    csv_dict['Input_1'] = word_to_string(normalized_a1)
+    csv_dict['Input_2'] = word_to_string(normalized_a2)
+    csv_dict['Input 1 length'] = len(normalized_a1)
+    csv_dict['Input 2 length'] = len(normalized_a2)
+    csv_dict['Personnages 1'] = d1
+    csv_dict['Personnages 2'] = d2
+
+    # An optimal solution is at least as good as any renaming
+    bound, min_matches, phases = None, None, None
+    initial_distance = None
+    if band or warm_start:
+        mapping, initial_distance = heuristic_mapping(normalized_a1, normalized_a2, heuristic_time_limit)
+    if band:
+        bound = initial_distance
+    if warm_start:
+        min_matches = (len(normalized_a1) + len(normalized_a2) - initial_distance) // 2
+        phases = solution_literals(normalized_a1, normalized_a2, mapping, bound)
+    csv_dict['Initial bound'] = initial_distance
+
+    # Now we call MaxHS
+    print('Calling MaxHS ...')
+    t2 = time.time()
+    positives = get_solver(solver).solve(f'{pair_name}_acte_{act_number}', [str(d1), str(d2)], normalized_a1,
+                                         normalized_a2, True, encoding=encoding, timeout=timeout, bound=bound,
+                                         min_matches=min_matches, phases=phases)
+
+    if positives is not None:  # Case with a succes before timeout
+        # Time spent by the solver only, to measure the effect of the warm start
+        csv_dict['Time to optimum'] = time.time() - t2
+        # Logging computing time
+        computing_time = time.time() - t1
+        log_line = f'{pair_name}, acte {act_number} : MaxHS execution time : {computing_time} \n'
+
+        # Decoding MaxHS answer
+        # (MaxHS gives us true literals, we now get back to actual character renaming and alignement)
+
+        print('Success, decoding MaxHS output ...')
+
+        human_readable_output = os.path.join(f'{final_output_dir}',
+                                             f'Comparaison {pair_name}  actes {act_number}')
+        decode_solution(d1, d2, normalized_a1, normalized_a2, positives, human_readable_output, csv_dict, bound)
+    else:  # Case with a timeout
+        computing_time = f' {timeout} (Timeout)'
+        log_line = f' {pair_name}, acte {act_number} : Timeout after {timeout} s \n'
+        print('Timeout')
+        csv_dict['Distance'] = None
+        csv_dict['Time to optimum'] = None
+        csv_dict['Input 1 renamed'] = None
+        csv_dict['Renaming'] = None
+    csv_dict['Computing time'] = computing_time
+    print(f'done for {pair_name}, act {act_number}')
+    return csv_dict, log_line
+
+
+def compare_acts_task(args):
+    """compare_acts with all its arguments in a tuple, for the process pool used by compare_pieces_corpus. The acts
+    compared are returned with its result, so that it can be stored in the cache."""
+    return args[2], args[3], compare_acts(*args)
+
+
+def comparison_cache_key(a1, a2, encoding='legacy', solver=MAXHS_PATH, band=False, warm_start=False,
+                         heuristic_time_limit=10):
+    """Returns the key of the comparison of two acts by compare_acts in a ResultCache (see result_cache.cache_key).
+    The options of compare_acts are part of the key, so that a result is only used by runs with the same options: the
+    rows logged depend on them, and so does the time needed to find the optimum.
+    >>> act_1, act_2 = ['#didon', '#enee'], ['#enee', '#didon', '#enee']
+    >>> comparison_cache_key(act_1, act_2) == comparison_cache_key(act_1, act_2, warm_start=True)
+    False
+    """
+    # The time limit of the heuristic only matters when its renaming is used
+    heuristic = heuristic_time_limit if band or warm_start else None
+    algorithm = f'maxsat {encoding} {get_solver(solver)!r} band={band} warm_start={warm_start} heuristic={heuristic}'
+    # compare_acts always encodes the problem with bijective=True
+    return cache_key(encoded_act(a1)[0], encoded_act(a2)[0], True, False, algorithm)
+
+
+def get_cached_comparison(cache, pair_name, act_number, a1, a2, timeout, options=()):
+    """Returns the result of the comparison of two acts stored in a ResultCache, as compare_acts, or None if it is not
+    in the cache, if it timed out with a smaller timeout, or if it was computed with other options (encoding, solver,
+    band, warm_start and heuristic_time_limit, as given to compare_acts)."""
+    cached = cache.get(comparison_cache_key(a1, a2, *options), timeout)
+    if cached is None:
+        return None
+    csv_dict = cached['row']
+    csv_dict['Pair name'] = pair_name
+    csv_dict['Act Number'] = act_number
+    return csv_dict, f'{pair_name}, acte {act_number} : already in the cache \n'
+
+
+def cache_comparison(cache, a1, a2, csv_dict, timeout, options=()):
+    """Stores the result of the comparison of two acts, as returned by compare_acts with the given options (see
+    get_cached_comparison), in a ResultCache."""
+    key = comparison_cache_key(a1, a2, *options)
+    optimal = csv_dict['Distance'] is not None
+    computing_time = csv_dict['Computing time'] if optimal else timeout
+    cache.put(key, csv_dict['Distance'], csv_dict['Renaming'], optimal, computing_time, timeout, csv_dict)
+
+
+def compare_pieces(f1, f2, pair_name, logs_files, csv_writer, final_output_dir, timeout=800, encoding='legacy',
+                   solver=MAXHS_PATH, cache=None, band=False, warm_start=False, heuristic_time_limit=10):
+    """Given two files of plays, run the comparison between them with MaxHS and logs the results.
+    Logs the details of computation in logs_files and writes the results in a given csv file.
+    Args:
+        f1 (str): Path to first play
+        f2 (str): Path to second play
+        pair_name(str): Name of the two plays compared
+        logs_files(_io.TextIOWrapper) : log file
+        csv_writer(csv.DictWriter) : Writer for the csv output
+        final_output_dir(str):Path to the directory where to save results
+        timeout(int): Time in seconds to execute MaxHS before timing out
+        encoding(str): 'legacy' or 'compact' clause encoding (see make_sat_instance)
+        solver(str or solver backend): Path of the MaxHS executable, or solver backend (ExternalSolver, RC2Solver)
+        cache(ResultCache): When given, act pairs already compared are not compared again (see result_cache.py),
+            unless their comparison timed out with a smaller timeout, and new results are stored in it
+        band(bool): When True, matches are restricted to a band around the diagonal (see compare_acts)
+        warm_start(bool): When True, the solver starts from a heuristic solution (see compare_acts)
+        heuristic_time_limit(float): Time in seconds given to each search of the heuristic used by band and
+            warm_start (see compare_acts)
+        """
+    options = (encoding, solver, band, warm_start, heuristic_time_limit)
     # We compare act 1 with act 1, 2 with 2, etc
-    for (act_number, (a1, a2)) in enumerate(zip(acts1, acts2)):
-        # New act
-        print(f'Act {act_number + 1}')
-        csv_dict['Act Number'] = act_number + 1
-
-        # Encoding the acts as parameteried words, and creating the maxhs input file
-        t1 = time.time()  # Measuring computing time of MaxHS on this instance
-        input_name, d1, d2, normalized_a1, normalized_a2 = encode_scenes(a1, a2, f'{pair_name}_acte_{act_number + 1}',
-                                                                         True)
-        csv_dict['Input_1'] = normalized_a1
-        csv_dict['Input_2'] = normalized_a2
-        csv_dict['Input 1 length'] = len(normalized_a1)
-        csv_dict['Input 2 length'] = len(normalized_a2)
-        csv_dict['Personnages 1'] = d1
-        csv_dict['Personnages 2'] = d2
-
-        # Preparing maxHS output file
-        output_name = f"{input_name}_output"
-
-        # Now we call MaxHS
-        print('Calling MaxHS ...')
-
-        try:  # Case with a succes before timeout
-            maxhs_answer = subprocess.run(['/usr/local/MaxHS-2021_eval/build/release/bin/maxhs', '-printSoln',
-                                           input_name], capture_output=True, text=True, timeout=timeout)
-            # Logging computing time
-            computing_time = time.time() - t1
-            logs_files.write(f'{pair_name}, acte {act_number + 1} : MaxHS execution time : {computing_time} \n')
-
-            # Saving MaxHS answer
-            output_file = open(output_name, 'w')
-            output_file.write(maxhs_answer.stdout)
-            output_file.close()
-
-            # Decoding MaxHS answer
-            # (MaxHS gives us true literals, we now get back to actual character renaming and alignement)
-
-            print('Success, decoding MaxHS output ...')
-
-            human_readable_output = os.path.join(f'{final_output_dir}',
-                                                 f'Comparaison {pair_name}  actes {act_number + 1}')
-            decode_max_hs_output(d1, d2, normalized_a1, normalized_a2, output_name, human_readable_output, csv_dict)
-        except subprocess.TimeoutExpired:  # Case with a timeout
-            computing_time = f' {timeout} (Timeout)'
-            logs_files.write(f' {pair_name}, acte {act_number + 1} : Timeout after {timeout} s \n')
-            print('Timeout')
-            csv_dict['Distance'] = None
-            csv_dict['Input 1 renamed'] = None
-            csv_dict['Renaming'] = None
-        csv_dict['Computing time'] = computing_time
+    for (pair_name, act_number, a1, a2) in get_act_jobs(f1, f2, pair_name):
+        cached = get_cached_comparison(cache, pair_name, act_number, a1, a2, timeout, options) \
+            if cache is not None else None
+        if cached is not None:
+            csv_dict, log_line = cached
+        else:
+            csv_dict, log_line = compare_acts(pair_name, act_number, a1, a2, final_output_dir, timeout, encoding,
+                                              solver, band, warm_start, heuristic_time_limit)
+            if cache is not None:
+                cache_comparison(cache, a1, a2, csv_dict, timeout, options)
+        logs_files.write(log_line)
         csv_writer.writerow(csv_dict)
-        print(f'done for act {act_number + 1}')
 
 
-def compare_pieces_corpus(folder, final_output_dir='Resultats comparaison'):
-    """Compare all pairs of plays in the specified folder by iterating compare_piece.
+def compare_pieces_corpus(folder, final_output_dir='Resultats comparaison', encoding='legacy', timeout=800,
+                          workers=1, solver=MAXHS_PATH, cache_path=None, use_index=False, band=False,
+                          warm_start=False, heuristic_time_limit=10):
+    """Compare all pairs of plays in the specified folder, act by act (see compare_acts).
     Logs all the results in a csv file.
+    The comparisons of acts run in a pool of workers processes, longest first (the size n*m of the instance is used as
+    an estimate of its difficulty), so that the last ones to finish are short. Only this process writes in the csv and
+    log files, as each comparison ends, so the rows are not in the order of the acts.
     Args:
         folder(str):path of the folder containing plays to compare. Must be a folder of folders containing 2 plays.
         final_output_dir(str): path of the directory where to write the output
+        encoding(str): 'legacy' or 'compact' clause encoding (see make_sat_instance)
+        timeout(int): Time in seconds to execute MaxHS on each pair of acts before timing out
+        workers(int): number of comparisons running at the same time
+        solver(str or solver backend): Path of the MaxHS executable, or solver backend (ExternalSolver, RC2Solver)
+        cache_path(str): When given, path of the database where results are kept from one run to the next (see
+            result_cache.py), so that only the act pairs not compared yet are computed
+        use_index(bool): When True, plays are read from the index of the corpus (see corpus_index.py), which is
+            created or updated first, instead of being parsed
+        band(bool): When True, matches are restricted to a band around the diagonal (see compare_acts)
+        warm_start(bool): When True, the solver starts from a heuristic solution (see compare_acts)
+        heuristic_time_limit(float): Time in seconds given to each search of the heuristic used by band and
+            warm_start (see compare_acts)
         """
     # Getting the folder of pairs to compare
     folders = os.listdir(folder)
     # Creating output csv file
     output_csv = open(os.path.join(final_output_dir, 'comparisons.csv'), 'w')
-    fieldnames = ['Pair name', 'Act Number', 'Distance', 'Input_1', 'Input_2', 'Renaming', 'Input 1 renamed',
-                  'Input 1 length', 'Input 2 length', 'Computing time', 'Personnages 1', 'Personnages 2']
+    fieldnames = ['Pair name', 'Act Number', 'Initial bound', 'Distance', 'Input_1', 'Input_2', 'Renaming',
+                  'Input 1 renamed', 'Input 1 length', 'Input 2 length', 'Time to optimum', 'Computing time',
+                  'Personnages 1', 'Personnages 2']
     # todo : ajouter nombre de persos
     gwriter = csv.DictWriter(output_csv, fieldnames=fieldnames)
     gwriter.writeheader()
 
-    folders.sort(key=lambda x: os.path.getsize(os.path.join(folder, x)))
-    logs_file = open(os.path.join(final_output_dir, 'Logs maxHS comparison'), 'w')
+    index = load_corpus_index(folder) if use_index else None
+    jobs = []
     for f in folders:
         pair_name = f
-        print(f'Comparing {pair_name}')
         folder_path = os.path.join(folder, f)
         if os.path.isdir(folder_path):
             plays = os.listdir(folder_path)
             play1, play2 = os.path.join(folder_path, plays[0]), os.path.join(folder_path, plays[1])
-            compare_pieces(play1, play2, pair_name, logs_file, gwriter, final_output_dir)
+            jobs += [(pair_name, act_number, a1, a2, final_output_dir, timeout, encoding, solver, band, warm_start,
+                      heuristic_time_limit)
+                     for (pair_name, act_number, a1, a2) in get_act_jobs(play1, play2, pair_name, index)]
+    jobs.sort(key=lambda job: len(job[2][0]) * len(job[3][0]), reverse=True)
+
+    logs_file = open(os.path.join(final_output_dir, 'Logs maxHS comparison'), 'w')
+    cache = ResultCache(cache_path) if cache_path is not None else None
+    options = (encoding, solver, band, warm_start, heuristic_time_limit)
+
+    def log_results(results, from_cache=False):
+        for (a1, a2, (csv_dict, log_line)) in results:
+            if cache is not None and not from_cache:
+                cache_comparison(cache, a1, a2, csv_dict, timeout, options)
+            logs_file.write(log_line)
+            logs_file.flush()
+            gwriter.writerow(csv_dict)
+            output_csv.flush()
+
+    if cache is not None:
+        # The results already in the cache are logged first, and only the other comparisons are run
+        remaining_jobs = []
+        for job in jobs:
+            cached = get_cached_comparison(cache, *job[:4], timeout, options)
+            if cached is not None:
+                log_results([(job[2], job[3], cached)], from_cache=True)
+            else:
+                remaining_jobs.append(job)
+        jobs = remaining_jobs
+
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            log_results(pool.imap_unordered(compare_acts_task, jobs))
+    else:
+        log_results(map(compare_acts_task, jobs))
+    if cache is not None:
+        cache.close()
+    logs_file.close()
+    output_csv.close()
 
 
 if __name__ == "__main__":
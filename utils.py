@@ -1,4 +1,7 @@
+from array import array
+from collections import Counter
 from xml.dom import minidom
+from xml.etree import ElementTree
 import doctest
 
 def invert_dic(d, v):
@@ -16,6 +19,15 @@ def invert_dic(d, v):
     return None
 
 
+def inverse_dic(d):
+    """Given a dictionnary, returns the dictionnary associating to each value v the first key k such that d[k] = v,
+    so that looking up many values does not scan d each time (see invert_dic)
+    >>> inverse_dic({1:'a',2:'a', 3:'b'})
+    {'b': 3, 'a': 1}
+    """
+    return {v: k for (k, v) in reversed(d.items())}
+
+
 def get_title(doc):
     """Returns the title of a play"""
     title_nodes = doc.getElementsByTagName('title')
@@ -31,7 +43,8 @@ def get_stances_succession(s):
 
 
 def normalize_scene(scene, return_dict = False):
-    """Given a list of characters, transforms it in a parameterized word of the form ABABC"""
+    """Given a list of characters, transforms it in a parameterized word of the form ABABC. Beyond 26 characters, the
+    letters are followed by other symbols ([, \\, ], ...): the comparisons use encode_scene instead."""
     character_normalizing = dict()
     order = 65
     normalized_scene = []
@@ -46,8 +59,293 @@ def normalize_scene(scene, return_dict = False):
         return "".join(normalized_scene)
 
 
+def encode_scene(scene, return_dict=False):
+    """Given a list of characters, transforms it in a parameterized word written with integers, each character being
+    replaced by its rank of first appearance (0, 1, 0, 1, 2 for ABABC). The word is an array of unsigned shorts, so
+    scenes with any number of characters (up to 65536) can be compared.
+    Args:
+        scene(list): Succession of characters
+        return_dict(bool): When True, the dictionnary associating each character to its integer is returned as well
+    Returns:
+        array: parameterized word, and the dictionnary when return_dict is True
+    >>> encode_scene(['#didon', '#enee', '#didon'], True)
+    (array('H', [0, 1, 0]), {'#didon': 0, '#enee': 1})
+    """
+    character_numbers = dict()
+    word = array('H', [character_numbers.setdefault(x, len(character_numbers)) for x in scene])
+    if return_dict:
+        return word, character_numbers
+    return word
+
+
+def word_to_string(word):
+    """Writes a parameterized word given with integers as text, for logging purposes: with letters (A for 0, B for 1,
+    etc) when it uses at most 26 characters, and with integers separated by spaces otherwise. Strings are returned as
+    they are.
+    >>> word_to_string([0, 1, 0, 2])
+    'ABAC'
+    >>> word_to_string(range(25, 28))
+    '25 26 27'
+    """
+    if isinstance(word, str):
+        return word
+    if max(word, default=0) < 26:
+        return ''.join([chr(65 + x) for x in word])
+    return ' '.join([str(x) for x in word])
+
+
 def get_all_acts_dialogues(doc):
     """Returns the succession of characters talking, in all acts"""
     scene_list = doc.getElementsByTagName('div') + doc.getElementsByTagName('div1') + doc.getElementsByTagName('div2')
     scene_list = [s for s in scene_list if s.getAttribute("type") in ["act", "acte"]]
-    return [get_stances_succession(s) for s in scene_list]
\ No newline at end of file
+    return [get_stances_succession(s) for s in scene_list]
+
+
+# Tags of the elements which can be acts, in the order in which get_all_acts_dialogues lists them
+ACT_TAGS = ['div', 'div1', 'div2']
+
+
+def parse_play(source):
+    """Reads a play in the TEI format in a single pass, without building its whole tree (each element is dropped as
+    soon as it ends), and returns the same title and acts as get_title and get_all_acts_dialogues on its minidom
+    document: acts written with div come first, then those written with div1, then div2, and the speeches of an act
+    nested in another one are in both.
+    Args:
+        source(str or file): Path of the play, or play opened in binary mode
+    Returns:
+        (str,list): Title of the play (None if it has none), and succession of characters talking in each act
+    >>> play = (b'<TEI xmlns="http://www.tei-c.org/ns/1.0"><title>Didon</title><div1 type="act"><sp who="#enee"/>'
+    ...         b'</div1><div type="acte"><sp who="#didon"/><sp/></div></TEI>')
+    >>> import io
+    >>> parse_play(io.BytesIO(play))
+    ('Didon', [['#didon', ''], ['#enee']])
+
+    Same result as minidom on all the plays of corpus10pairs:
+    >>> import os
+    >>> corpus = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus10pairs')
+    >>> pairs = [os.path.join(corpus, pair) for pair in sorted(os.listdir(corpus))]
+    >>> plays = [os.path.join(pair, name) for pair in pairs if os.path.isdir(pair)
+    ...          for name in sorted(os.listdir(pair))]
+    >>> len(plays)
+    20
+    >>> [play for play in plays if parse_play(play) != (get_title(minidom.parse(play)),
+    ...                                                 get_all_acts_dialogues(minidom.parse(play)))]
+    []
+    """
+    title, first_title = None, None
+    acts = {tag: [] for tag in ACT_TAGS}
+    # Elements started and not ended yet, and acts among them, with their depth
+    open_elements, open_acts = [], []
+    for (event, element) in ElementTree.iterparse(source, events=('start', 'end')):
+        tag = element.tag.rpartition('}')[2]
+        if event == 'start':
+            open_elements.append(element)
+            if tag == 'title' and first_title is None:
+                first_title = element
+            elif tag in acts and element.get('type') in ["act", "acte"]:
+                speakers = []
+                acts[tag].append(speakers)
+                open_acts.append((len(open_elements), speakers))
+            elif tag == 'sp':
+                for (_, speakers) in open_acts:
+                    speakers.append(element.get('who', ''))
+        else:
+            if element is first_title:
+                title = element.text
+            if open_acts and open_acts[-1][0] == len(open_elements):
+                open_acts.pop()
+            open_elements.pop()
+            if open_elements:
+                open_elements[-1].remove(element)
+    return title, [speakers for tag in ACT_TAGS for speakers in acts[tag]]
+
+
+def position_masks(integer_list, alphabet_size=None):
+    """Given a word written as a list of integers, returns for each integer the bitmask of its positions in the word
+    >>> position_masks([0, 1, 0, 2])
+    [5, 2, 8]
+    """
+    if alphabet_size is None:
+        alphabet_size = max(integer_list, default=-1) + 1
+    masks = [0] * alphabet_size
+    for j, c in enumerate(integer_list):
+        masks[c] |= 1 << j
+    return masks
+
+
+def advance_lcs_state(state, row_masks, full):
+    """Processes new positions of the first word in the bit-parallel computation of a longest common subsequence
+    (Hyyro's algorithm). row_masks gives, for each new position, the bitmask of the positions of the second word it
+    matches, and full the bitmask of all positions of the second word. The computation starts from state = full, and
+    the length of the longest common subsequence is the number of zeros of the state among the bits of full.
+    """
+    for mask in row_masks:
+        u = state & mask
+        state = ((state + u) | (state - u)) & full
+    return state
+
+
+def advance_lcs_state_bounded(state, row_masks, full, needed, block_size=64):
+    """As advance_lcs_state, but gives up as soon as the longest common subsequence cannot reach the length needed.
+    With k positions of the first word left, a common subsequence can gain at most k positions, and if it gains k of
+    them, they are matched with positions of the second word after its first width - k ones: the final length is at
+    most the length for the first width - k positions of the second word, plus k (Ukkonen's diagonal argument). This
+    is checked after each block of block_size positions.
+    Returns:
+        int: state after all the positions, or None if the computation stopped
+    >>> advance_lcs_state_bounded(3, [1, 2, 1], 3, 2, 1)
+    0
+    >>> advance_lcs_state_bounded(3, [0, 0, 1], 3, 2, 1) is None
+    True
+    """
+    width = full.bit_length()
+    for start in range(0, len(row_masks), block_size):
+        state = advance_lcs_state(state, row_masks[start:start + block_size], full)
+        left = max(len(row_masks) - start - block_size, 0)
+        column = width - left
+        if column > 0 and column - bin(state & ((1 << column) - 1)).count('1') + left < needed:
+            return None
+    return state
+
+
+def bit_parallel_lcs(row_masks, width):
+    """Returns the length of a longest common subsequence of a word whose positions match the positions of a second
+    word of length width given by row_masks
+    >>> bit_parallel_lcs([1, 2, 1], 2)
+    2
+    """
+    full = (1 << width) - 1
+    return width - bin(advance_lcs_state(full, row_masks, full)).count('1')
+
+
+def mapping_masks(b_masks, mapping):
+    """Given the position masks of the characters of a word b and a mapping from characters of a word a to
+    characters of b, returns for each character of a the bitmask of the positions of b it matches. A character may be
+    mapped to a single character, to a collection of characters (the masks are OR-ed, which is used to treat it as a
+    wildcard) or to None (it matches nothing).
+    >>> mapping_masks([5, 2, 8], [2, None, (0, 1)])
+    [8, 0, 7]
+    """
+    if isinstance(mapping, dict):
+        mapping = [mapping.get(c) for c in range(max(mapping, default=-1) + 1)]
+    masks = []
+    for image in mapping:
+        if image is None:
+            masks.append(0)
+        elif hasattr(image, '__iter__'):
+            mask = 0
+            for d in image:
+                mask |= b_masks[d] if d < len(b_masks) else 0
+            masks.append(mask)
+        else:
+            masks.append(b_masks[image] if image < len(b_masks) else 0)
+    return masks
+
+
+def indel_distance(a_integer_list, b_integer_list, mapping, b_masks=None):
+    """Returns the insertion/deletion distance between two words written as lists of integers, once the characters of
+    the first one are renamed with mapping (a list or dictionnary, see mapping_masks). Neither word is rebuilt: the
+    positions matched by each character of a are obtained from position masks computed once for b.
+    >>> indel_distance([0, 1, 0, 1], [0, 1, 1, 0], [1, 0])
+    2
+    >>> indel_distance([0, 1, 0, 1], [0, 1, 1, 0], {0: 0})
+    4
+    """
+    if b_masks is None:
+        b_masks = position_masks(b_integer_list)
+    masks = mapping_masks(b_masks, mapping)
+    row_masks = [masks[c] if c < len(masks) else 0 for c in a_integer_list]
+    width = len(b_integer_list)
+    return len(a_integer_list) + width - 2 * bit_parallel_lcs(row_masks, width)
+
+
+def bounded_indel_distance(a_integer_list, b_integer_list, mapping, bound, b_masks=None):
+    """Returns the same distance as indel_distance when it is smaller than bound, and bound otherwise. The computation
+    stops as soon as the distance cannot be smaller than bound (see advance_lcs_state_bounded), so a search which only
+    looks for distances smaller than the best one found so far rejects most candidates after a part of the word.
+    >>> bounded_indel_distance([0, 1, 0, 1], [0, 1, 1, 0], [1, 0], 3)
+    2
+    >>> bounded_indel_distance([0, 1, 0, 1], [0, 1, 1, 0], {0: 0}, 3)
+    3
+    """
+    if b_masks is None:
+        b_masks = position_masks(b_integer_list)
+    masks = mapping_masks(b_masks, mapping)
+    row_masks = [masks[c] if c < len(masks) else 0 for c in a_integer_list]
+    width = len(b_integer_list)
+    full = (1 << width) - 1
+    # A distance smaller than bound needs a common subsequence of more than (|a| + |b| - bound) / 2 positions
+    needed = (len(a_integer_list) + width - bound) // 2 + 1
+    state = advance_lcs_state_bounded(full, row_masks, full, needed)
+    if state is None:
+        return bound
+    return min(bound, len(a_integer_list) + width - 2 * (width - bin(state).count('1')))
+
+
+def alignment_matches(a_integer_list, b_integer_list, mapping):
+    """Returns the pairs of positions (i, j) matched by an optimal insertion/deletion alignment of two words written as
+    lists of integers, once the characters of the first one are renamed with mapping (a dictionnary): a longest common
+    subsequence, computed by dynamic programming. Unlike indel_distance, it gives the alignment itself, in O(nm).
+    >>> alignment_matches([0, 1, 0, 1], [0, 1, 1, 0], {0: 1, 1: 0})
+    [(1, 0), (2, 1), (3, 3)]
+    """
+    n, m = len(a_integer_list), len(b_integer_list)
+    renamed = [mapping.get(c) for c in a_integer_list]
+    # lengths[i][j] is the length of a longest common subsequence of the suffixes starting at positions i and j
+    lengths = [[0] * (m + 1) for _ in range(n + 1)]
+    for i in range(n - 1, -1, -1):
+        row, next_row = lengths[i], lengths[i + 1]
+        for j in range(m - 1, -1, -1):
+            if renamed[i] == b_integer_list[j]:
+                row[j] = next_row[j + 1] + 1
+            else:
+                row[j] = max(next_row[j], row[j + 1])
+    matches, i, j = [], 0, 0
+    while i < n and j < m:
+        if renamed[i] == b_integer_list[j]:
+            matches.append((i, j))
+            i, j = i + 1, j + 1
+        elif lengths[i + 1][j] >= lengths[i][j + 1]:
+            i += 1
+        else:
+            j += 1
+    return matches
+
+
+def frequency_mapping(a_integer_list, b_integer_list):
+    """Cheap renaming of the characters of a word into the characters of another one, associating the k-th most
+    frequent character of the first word to the k-th most frequent character of the second one (ties are broken by
+    order of first appearance). Only the characters of the largest alphabet which are beyond the size of the smallest
+    one are left out, so that the renaming is injective both ways. Its distance (see indel_distance) is an upper bound
+    of the distance.
+    >>> frequency_mapping([0, 1, 1, 2], [0, 0, 1])
+    {1: 0, 0: 1}
+    """
+    a_counts = [0] * (max(a_integer_list, default=-1) + 1)
+    for c in a_integer_list:
+        a_counts[c] += 1
+    b_counts = [0] * (max(b_integer_list, default=-1) + 1)
+    for c in b_integer_list:
+        b_counts[c] += 1
+    a_order = sorted(range(len(a_counts)), key=lambda c: -a_counts[c])
+    b_order = sorted(range(len(b_counts)), key=lambda c: -b_counts[c])
+    return dict(zip(a_order, b_order))
+
+
+def assignment_lower_bound(a_integer_list, b_integer_list):
+    """Returns a lower bound of the insertion/deletion distance between two words written as lists of integers, for
+    all the injections from the characters of the first one to the characters of the second one. The matches of an
+    alignment pair characters c of a with their images d, and there are at most as many of them as in a longest
+    common subsequence of the projections of a onto c and of b onto d, that is min(#c, #d). The largest number of
+    matches is thus bounded by a maximum weight matching between the characters of both words, with these weights,
+    and as the weights are minimums of numbers of occurrences, pairing the characters by decreasing number of
+    occurrences is such a matching: no assignment solver is needed.
+    >>> assignment_lower_bound([0, 0, 1], [0, 1, 1, 1])
+    1
+    >>> assignment_lower_bound([0, 1, 0, 1], [0, 1, 2, 2, 2])
+    3
+    """
+    a_counts = sorted(Counter(a_integer_list).values(), reverse=True)
+    b_counts = sorted(Counter(b_integer_list).values(), reverse=True)
+    matches = sum(min(x, y) for (x, y) in zip(a_counts, b_counts))
+    return len(a_integer_list) + len(b_integer_list) - 2 * matches